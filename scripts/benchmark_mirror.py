@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# Measures how fast mirror_julia.py synchronizes, without touching the network. A synthetic registry
+# is generated in a local git repository, and a local HTTP server stands in for the GitHub tarball
+# API, codeload and the S3 buckets of the Julia releases and nightly builds.
+import argparse
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+import git
+import toml
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Runs mirror_julia.py with the upstream URLs pointed at the local server.
+BOOTSTRAP = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import mirror_julia
+mirror_julia.Config.REMOTE_RELEASEINFO = sys.argv[2] + '/releaseinfo.json'
+mirror_julia.Config.GITHUB_API = sys.argv[2]
+mirror_julia.Config.CLIENT_URL = sys.argv[3]
+sys.argv = ['mirror_julia.py'] + sys.argv[4:]
+mirror_julia.main()
+'''
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark mirror_julia.py against a synthetic registry and a local HTTP server.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--workdir', type=str, default=None,
+                        help='directory for the generated files and the mirror (default: a temporary one)')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--packages', type=int, default=200, help='number of packages in the registry')
+    parser.add_argument('--versions', type=int, default=5, help='number of versions of each package')
+    parser.add_argument('--tarball-size', type=int, default=64 << 10, help='size of a package tarball in bytes')
+    parser.add_argument('--releases', type=int, default=3, help='number of Julia release versions')
+    parser.add_argument('--release-files', type=int, default=4, help='number of files of each release')
+    parser.add_argument('--release-size', type=int, default=1 << 20, help='size of a release file in bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--throughput', type=int, default=0,
+                        help='bytes per second sent on each connection, 0 for no limit')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of answering a request with an error')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the injected errors')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='requests to the tarball API allowed for each token (see --host-token) in each '
+                             '--rate-window, 0 for no limit')
+    parser.add_argument('--rate-window', type=float, default=1.0, help='seconds until the rate limits reset')
+    parser.add_argument('--retry-after', action='store_true',
+                        help='refuse the requests over the rate limit with 429 and Retry-After instead of 403 '
+                             'and X-RateLimit-*, like the secondary limits of GitHub')
+    parser.add_argument('--json', type=str, default=None, help='also save the results to this file')
+    parser.add_argument('mirror_args', nargs=argparse.REMAINDER,
+                        help='arguments passed to mirror_julia.py after "--"')
+    args = parser.parse_args()
+    if args.mirror_args[:1] == ['--']:
+        args.mirror_args = args.mirror_args[1:]
+    return args
+
+
+def get_sha(*parts):
+    return hashlib.sha1('/'.join(str(p) for p in parts).encode()).hexdigest()
+
+
+def get_uuid(*parts):
+    sha = get_sha(*parts)
+    return '%s-%s-%s-%s-%s' % (sha[:8], sha[8:12], sha[12:16], sha[16:20], sha[20:32])
+
+
+def get_tree_content(name, version, args):
+    # The only file of the tree of a version of a package.
+    return ('%s %s\n' % (name, version)).encode() + get_filler(args)[:args.tarball_size]
+
+
+def get_filler(args):
+    return random.Random(args.seed).randbytes(max(args.tarball_size, args.release_size))
+
+
+def get_tree_sha(content):
+    # The git-tree-sha1 of a tree with `content` as its only file, named `data`.
+    blob = hashlib.sha1(b'blob %d\0' % len(content) + content).digest()
+    entry = b'100644 data\0' + blob
+    return hashlib.sha1(b'tree %d\0' % len(entry) + entry).hexdigest()
+
+
+def make_tarball(prefix, content):
+    # Like the tarballs of GitHub, the files are in a top level directory. The archive does not
+    # depend on the time, so that its ETag does not change.
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1, mtime=0) as fo:
+        with tarfile.open(fileobj=fo, mode='w') as tar:
+            info = tarfile.TarInfo(prefix)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+            info = tarfile.TarInfo(prefix + '/data')
+            info.size = len(content)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def commit_all(repo, message):
+    repo.git.add('-A')
+    repo.git.commit('-q', '-m', message, '--allow-empty')
+
+
+def make_registry(path, args):
+    # Returns {git-tree-sha1: (name, version)} of the versions of all the packages.
+    repo = git.Repo.init(path)
+    with repo.config_writer() as writer:
+        writer.set_value('user', 'name', 'benchmark')
+        writer.set_value('user', 'email', 'benchmark@localhost')
+    packages = {}
+    trees = {}
+    for i in range(args.packages):
+        name = 'Bench%05d' % i
+        uuid = get_uuid('uuid', name)
+        package_dir = os.path.join(path, name[0], name)
+        os.makedirs(package_dir, exist_ok=True)
+        with open(os.path.join(package_dir, 'Package.toml'), 'w') as fo:
+            toml.dump({'name': name, 'uuid': uuid, 'repo': 'https://github.com/bench/%s.jl.git' % name}, fo)
+        versions = {}
+        for j in range(args.versions):
+            version = '0.%d.0' % j
+            sha = get_tree_sha(get_tree_content(name, version, args))
+            versions[version] = {'git-tree-sha1': sha}
+            trees[sha] = (name, version)
+        with open(os.path.join(package_dir, 'Versions.toml'), 'w') as fo:
+            toml.dump(versions, fo)
+        packages[uuid] = {'name': name, 'path': '%s/%s' % (name[0], name)}
+    with open(os.path.join(path, 'Registry.toml'), 'w') as fo:
+        toml.dump({'name': 'Bench', 'uuid': get_uuid('registry'), 'packages': packages}, fo)
+    commit_all(repo, 'Generate the registry')
+    return trees
+
+
+def make_client(path):
+    repo = git.Repo.init(path)
+    with open(os.path.join(path, 'README.md'), 'w') as fo:
+        fo.write('Stand-in for PkgMirrors.jl\n')
+    with repo.config_writer() as writer:
+        writer.set_value('user', 'name', 'benchmark')
+        writer.set_value('user', 'email', 'benchmark@localhost')
+    commit_all(repo, 'Add README')
+
+
+def get_release_files(args):
+    # Returns the paths of the files of each release version on the server, like in the S3 buckets.
+    files = {'latest': ['julianightlies/bin/linux/x64/julia-latest-%d.tar.gz' % i
+                        for i in range(args.release_files)]}
+    for i in range(args.releases):
+        version = 'v1.%d' % i
+        files[version] = ['julialang2/bin/linux/x64/1.%d/julia-1.%d.0-%d.tar.gz' % (i, i, j)
+                          for j in range(args.release_files)]
+    return files
+
+
+# Serves the releases, the S3 listings and the package tarballs. All the files are generated from
+# their paths, so nothing needs to be written on disk. The package tarballs are real archives of the
+# trees named in the registry, so that --pkg-server can convert them.
+class BenchmarkServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args, trees):
+        super().__init__(('127.0.0.1', 0), BenchmarkHandler)
+        self.args = args
+        self.trees = trees
+        self.base = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.release_files = get_release_files(args)
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.filler = get_filler(args)
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.rate_limited = 0
+            self.bytes_sent = 0
+            # {token: [reset, used]} of the rate limits.
+            self.windows = {}
+
+    def get_releaseinfo(self):
+        versions = {}
+        for (version, paths) in self.release_files.items():
+            versions[version] = {
+                'subversion': 'latest' if version == 'latest' else version + '.0',
+                'urllist': [[os.path.basename(p), '%s/%s' % (self.base, p)] for p in paths]
+            }
+        return json.dumps({'versions': versions}).encode()
+
+    def get_file(self, path):
+        # Returns the content of a file and its ETag, or `None` if there is no such file.
+        if path == '/releaseinfo.json':
+            data = self.get_releaseinfo()
+        elif re.match(r'^/codeload/[^/]+/[^/]+/tarball/[0-9a-f]{40}$', path) and path[-40:] in self.trees:
+            (name, version) = self.trees[path[-40:]]
+            prefix = 'bench-%s.jl-%s' % (name, path[-40:][:7])
+            data = make_tarball(prefix, get_tree_content(name, version, self.args))
+        elif any(path[1:] in paths for paths in self.release_files.values()):
+            data = path.encode() + b'\n' + self.filler[:self.args.release_size]
+        else:
+            return None, None
+        return data, '"%s"' % hashlib.sha1(data).hexdigest()
+
+    def use_rate_limit(self, token):
+        # Counts a request to the tarball API with `token`, and returns the requests left (negative
+        # if it is refused) and the time when the limit resets.
+        with self.lock:
+            now = time.time()
+            window = self.windows.setdefault(token, [0, 0])
+            if window[0] <= now:
+                window[:] = [now + self.args.rate_window, 0]
+            window[1] += 1
+            remaining = self.args.rate_limit - window[1]
+            if remaining < 0:
+                self.rate_limited += 1
+            return remaining, window[0]
+
+    def should_fail(self):
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.args.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+
+class BenchmarkHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        # For the sizes in --plan.
+        self.respond(False)
+
+    def respond(self, with_body):
+        server = self.server
+        if server.args.latency > 0:
+            time.sleep(server.args.latency)
+        if server.should_fail():
+            self.send_error(500)
+            return
+        path = self.path.split('?')[0]
+        if re.match(r'^/repos/[^/]+/[^/]+/tarball/[^/]+$', path):
+            self.redirect_tarball(path)
+            return
+        data, etag = server.get_file(path)
+        if data is None:
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start = 0
+        m = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+        if m is not None and self.headers.get('If-Range') == etag and int(m.group(1)) < len(data):
+            start = int(m.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if with_body:
+            self.send_body(data[start:])
+
+    def redirect_tarball(self, path):
+        # Like GitHub, the API redirects to codeload and tells the rate limit in the redirect.
+        status = 302
+        headers = {'Location': '/codeload' + path[len('/repos'):]}
+        if self.server.args.rate_limit > 0:
+            (remaining, reset) = self.server.use_rate_limit(self.headers.get('Authorization'))
+            if remaining < 0 and self.server.args.retry_after:
+                status = 429
+                headers = {'Retry-After': str(max(1, math.ceil(reset - time.time())))}
+            elif remaining < 0:
+                status = 403
+                headers = {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(math.ceil(reset))}
+            else:
+                headers['X-RateLimit-Remaining'] = str(remaining)
+                headers['X-RateLimit-Reset'] = str(math.ceil(reset))
+        self.send_response(status)
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_body(self, data):
+        chunk_size = 1 << 16
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size]
+            self.wfile.write(chunk)
+            with self.server.lock:
+                self.server.bytes_sent += len(chunk)
+            if self.server.args.throughput > 0:
+                time.sleep(len(chunk) / self.server.args.throughput)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_mirror(server, workdir, mirror_args):
+    root = os.path.join(workdir, 'mirror')
+    command = [
+        sys.executable, '-c', BOOTSTRAP, SCRIPTS_DIR, server.base, os.path.join(workdir, 'client'),
+        root, '--no-metadata', '--no-general',
+        '--add-custom-registry', 'Bench', os.path.join(workdir, 'registry'),
+        '--logging-file', os.path.join(workdir, 'mirror.log')
+    ] + mirror_args
+    server.reset_counters()
+    start = time.monotonic()
+    returncode = subprocess.call(command)
+    elapsed = time.monotonic() - start
+    if returncode != 0:
+        print('mirror_julia.py exited with %d, see %s' % (returncode, os.path.join(workdir, 'mirror.log')))
+    return {
+        'seconds': elapsed,
+        'requests': server.requests,
+        'errors': server.errors,
+        'rate_limited': server.rate_limited,
+        'bytes': server.bytes_sent,
+        'returncode': returncode
+    }
+
+
+def count_tarballs(workdir):
+    count = 0
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(workdir, 'mirror', 'packages')):
+        count += len([f for f in filenames if re.match(r'^.*-[0-9a-f]{40}\.tar\.gz$', f)])
+    return count
+
+
+def count_server_trees(workdir):
+    # The package trees converted by --pkg-server.
+    package_dir = os.path.join(workdir, 'mirror', 'server', 'package')
+    if not os.path.isdir(package_dir):
+        return None
+    return sum(len(os.listdir(entry.path)) for entry in os.scandir(package_dir))
+
+
+def main():
+    args = get_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='julia-mirror-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    if os.path.exists(os.path.join(workdir, 'mirror')):
+        shutil.rmtree(os.path.join(workdir, 'mirror'))
+    print('Generating %d packages with %d versions each in %s' % (args.packages, args.versions, workdir))
+    for name in ('registry', 'client'):
+        if os.path.exists(os.path.join(workdir, name)):
+            shutil.rmtree(os.path.join(workdir, name))
+    trees = make_registry(os.path.join(workdir, 'registry'), args)
+    make_client(os.path.join(workdir, 'client'))
+    server = BenchmarkServer(args, trees)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        print('Running the first synchronization')
+        first = run_mirror(server, workdir, args.mirror_args)
+        tarballs = count_tarballs(workdir)
+        server_trees = count_server_trees(workdir)
+        print('Running a synchronization with nothing changed')
+        noop = run_mirror(server, workdir, args.mirror_args)
+    finally:
+        server.shutdown()
+        server.server_close()
+    # In kilobytes on Linux, the largest of all the processes that have been run.
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    results = {
+        'settings': {k: v for (k, v) in vars(args).items() if k not in ('workdir', 'keep', 'json')},
+        'first_sync': first,
+        'noop_sync': noop,
+        'tarballs': tarballs,
+        'server_trees': server_trees,
+        'expected_tarballs': args.packages * args.versions,
+        'packages_per_second': args.packages / first['seconds'],
+        'tarballs_per_second': tarballs / first['seconds'],
+        'bytes_per_second': first['bytes'] / first['seconds'],
+        'peak_rss_kb': peak_rss
+    }
+    print('')
+    print('Packages:           %d (%d of %d tarballs mirrored)' % (
+        args.packages, tarballs, results['expected_tarballs']))
+    print('First sync:         %.2f s, %d requests, %d injected errors, %d rate limited' % (
+        first['seconds'], first['requests'], first['errors'], first['rate_limited']))
+    print('Packages/sec:       %.1f' % results['packages_per_second'])
+    print('Tarballs/sec:       %.1f' % results['tarballs_per_second'])
+    print('Bytes/sec:          %.2f MB/s' % (results['bytes_per_second'] / (1 << 20)))
+    if server_trees is not None:
+        print('Pkg server trees:   %d' % server_trees)
+    print('No-op sync:         %.2f s, %d requests' % (noop['seconds'], noop['requests']))
+    print('Peak RSS:           %.1f MB' % (peak_rss / 1024))
+    if args.json is not None:
+        with open(args.json, 'w') as fo:
+            json.dump(results, fo, indent=4, sort_keys=True)
+    if not args.keep and args.workdir is None:
+        shutil.rmtree(workdir)
+    if first['returncode'] != 0 or noop['returncode'] != 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Finds the package tarballs that no registry refers to any more, e.g. of yanked or replaced
+# versions, together with their .sha256 files, version links and dangling links, and the objects
+# in the store that no package uses. Nothing is deleted without --delete.
+import argparse
+import concurrent.futures
+import glob
+import os
+import re
+
+from mirror_julia import Manifest, TomlCache, read_registry_versions
+
+SHA_REGEX = re.compile(r'^[0-9a-f]{40}$')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Remove unreferenced package tarballs and dangling links from a Julia mirror.'
+    )
+    parser.add_argument('pathname', type=str, help='path to the mirror root')
+    parser.add_argument('--delete', action='store_true',
+                        help='delete the files found instead of only reporting them (a dry run)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of threads walking the directories (default: %(default)s)')
+    parser.add_argument('--quiet', action='store_true', help='only print the summary')
+    return parser.parse_args()
+
+
+def load_registry(root, name):
+    # Returns {package_name: set of file names} of what the registry refers to in packages/, and
+    # the set of git-tree-sha1s it refers to.
+    registry_versions = read_registry_versions(
+        os.path.join(root, 'registries', name), TomlCache(os.path.join(root, 'cache', 'registries', name + '.json'))
+    )
+    packages = {}
+    shas = set()
+    for (package_name, versions) in registry_versions.items():
+        names = {package_name, '%s-latest.tar.gz' % package_name, '%s-latest.tar.gz.sha256' % package_name}
+        for (version, info) in versions.items():
+            sha = info['git-tree-sha1']
+            shas.add(sha)
+            for each in (sha, version):
+                names.add('%s-%s.tar.gz' % (package_name, each))
+                names.add('%s-%s.tar.gz.sha256' % (package_name, each))
+        packages[package_name] = names
+    return packages, shas
+
+
+def get_registries(root):
+    registries_dir = os.path.join(root, 'registries')
+    return sorted(
+        entry.name for entry in os.scandir(registries_dir)
+        if entry.is_dir(follow_symlinks=False) and os.path.isdir(os.path.join(registries_dir, entry.name + '.git'))
+    )
+
+
+def scan_package_dir(path, names):
+    # Returns (path, lstat) of the entries of packages/<name>/<registry> that are not in `names`,
+    # or that are links to nothing. With `names` as `None`, the package is not in the registry.
+    found = []
+    for entry in os.scandir(path):
+        st = entry.stat(follow_symlinks=False)
+        if names is None or entry.name not in names:
+            found.append((entry.path, st))
+        elif entry.is_symlink() and not os.path.exists(entry.path):
+            found.append((entry.path, st))
+    return found
+
+
+def scan_registry_links(registry_dir):
+    # Returns the `releases` links in the working tree of a registry that point to nothing.
+    found = []
+    for letter in os.scandir(registry_dir):
+        if letter.name.startswith('.') or not letter.is_dir(follow_symlinks=False):
+            continue
+        for package in os.scandir(letter.path):
+            link = os.path.join(package.path, 'releases')
+            if package.is_dir(follow_symlinks=False) and os.path.islink(link) and not os.path.exists(link):
+                found.append((link, os.lstat(link)))
+    return found
+
+
+def scan_objects_dir(path, shas):
+    found = []
+    for entry in os.scandir(path):
+        sha = entry.name.split('.', 1)[0]
+        if not SHA_REGEX.match(sha) or sha not in shas or not entry.name.endswith(('.tar.gz', '.tar.gz.sha256')):
+            found.append((entry.path, entry.stat(follow_symlinks=False)))
+    return found
+
+
+def remove_empty_dirs(path, top):
+    # Unlike `mirror_julia.remove_empty_dir`, never goes above `top`.
+    while path != top and os.path.isdir(path) and len(os.listdir(path)) == 0:
+        os.rmdir(path)
+        path = os.path.dirname(path)
+
+
+def main():
+    args = get_args()
+    root = os.path.abspath(args.pathname)
+    packages_dir = os.path.join(root, 'packages')
+    objects_dir = os.path.join(root, 'objects')
+    registries = get_registries(root)
+    print('Reading %d registries...' % len(registries))
+    referenced = {}
+    shas = set()
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        results = executor.map(lambda name: load_registry(root, name), registries)
+        for (name, (packages, registry_shas)) in zip(registries, results):
+            referenced[name] = packages
+            shas.update(registry_shas)
+        tasks = []
+        # Without its registry, nothing is known about what a package folder should keep.
+        skipped = set()
+        for package in os.scandir(packages_dir):
+            if not package.is_dir(follow_symlinks=False):
+                continue
+            for registry in os.scandir(package.path):
+                if not registry.is_dir(follow_symlinks=False):
+                    continue
+                if registry.name not in referenced:
+                    skipped.add(registry.name)
+                    continue
+                names = referenced[registry.name].get(package.name)
+                tasks.append(executor.submit(scan_package_dir, registry.path, names))
+        for name in sorted(skipped):
+            print('Warning: registry %s cannot be read, its packages are skipped.' % name)
+        for name in registries:
+            tasks.append(executor.submit(scan_registry_links, os.path.join(root, 'registries', name)))
+        # The objects may be used by the registries that are skipped.
+        if len(skipped) > 0:
+            print('Warning: objects/ is skipped, since those registries may use its tarballs.')
+        elif os.path.isdir(objects_dir):
+            for each in os.scandir(objects_dir):
+                if each.is_dir(follow_symlinks=False):
+                    tasks.append(executor.submit(scan_objects_dir, each.path, shas))
+        found = [each for task in tasks for each in task.result()]
+    # Space is only freed when every link to a file is deleted, e.g. a tarball in the store that is
+    # still used by another registry is not counted.
+    inodes = {}
+    links = 0
+    for (path, st) in sorted(found):
+        if not args.quiet:
+            print('%s %s' % ('Deleting' if args.delete else 'Unreferenced', os.path.relpath(path, root)))
+        if os.path.islink(path):
+            links += 1
+        else:
+            (count, _) = inodes.get((st.st_dev, st.st_ino), (0, st))
+            inodes[(st.st_dev, st.st_ino)] = (count + 1, st)
+    freed = sum(st.st_size for (count, st) in inodes.values() if count >= st.st_nlink)
+    if args.delete:
+        for (path, st) in found:
+            os.unlink(path)
+        for path in sorted(set(os.path.dirname(path) for (path, st) in found), reverse=True):
+            if path.startswith(packages_dir + os.sep):
+                remove_empty_dirs(path, packages_dir)
+            elif path.startswith(objects_dir + os.sep):
+                remove_empty_dirs(path, objects_dir)
+        # Shards keep their own manifest.shard-I-of-N.json, see --shard.
+        for filename in glob.glob(os.path.join(root, 'manifest*.json')):
+            manifest = Manifest(root, filename)
+            manifest.prune()
+            manifest.save()
+    print('%s %d files and %d links, %s %d bytes.' % (
+        'Deleted' if args.delete else 'Found', len(found) - links, links,
+        'freeing' if args.delete else 'which would free', freed
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,60 @@
 #!/usr/bin/env python3
+import abc
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import cProfile
 import datetime
+import email.utils
+import fcntl
+import functools
 import glob
+import gzip
 import hashlib
+import heapq
+import http.client
+import http.server
 import itertools
 import json
 import logging
 import multiprocessing.pool
+import multiprocessing.util
 import os
+import pstats
 import re
+import resource
 import shutil
 import socket
+import sqlite3
+import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
 
 import git
 import toml
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 
 VERSION = '1.0.0'
 
 class Config(object):
     DATEFMT = '%Y-%m-%d %H:%M:%S'
+    # Minimum number of seconds between two exports of status.json during a phase.
+    STATUS_EXPORT_INTERVAL = 60
+    # Seconds to wait before the first retry of a failed request. It doubles with each retry.
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 300
+    # Times a download can be put back into the queue after it has been rate limited.
+    MAX_REQUEUES = 10
     SETTINGS = ['mirror_releases', 'mirror_metadata', 'mirror_packages',
                 'registries', 'sync_latest', 'ignore_invalid']
     REMOTE_RELEASEINFO = 'https://github.com/sunoru/julia-mirror/raw/master/data/releaseinfo.json'
@@ -32,9 +64,20 @@ class Config(object):
         'General': 'https://github.com/JuliaRegistries/General.git'
     }
     REGISTRY_NAMES = list(REGISTRIES.keys())
+    GITHUB_API = 'https://api.github.com'
+    # Hosts of package repositories not listed here are fetched with git, see `get_fetcher`.
+    HOST_BACKENDS = {
+        'github.com': 'github',
+        'gitlab.com': 'gitlab'
+    }
 
     def __init__(self, root, mirror_releases, mirror_metadata, mirror_packages, registries, sync_latest,
-                 max_processes, ignore_invalid, temp_dir, logging_args, mirror_name):
+                 max_processes, ignore_invalid, temp_dir, logging_args, mirror_name, verify_all=False,
+                 full_scan=False, engine='process', concurrency=64, registry_workers=4,
+                 fetch_mode='tarball', host_backends=None, host_limits=None, host_retries=None,
+                 host_tokens=None, metrics_file=None, metrics_port=None, profile_dir=None,
+                 profile_python=False, plan_mode=None, plan_file=None, shard=None, merge_shards=False,
+                 pkg_server=False):
         self.root = os.path.abspath(root)
         self.mirror_releases = mirror_releases
         self.mirror_metadata = mirror_metadata
@@ -48,13 +91,83 @@ class Config(object):
         tempfile.tempdir = temp_dir
         self.packages = {}
         self.mirror_name = mirror_name
+        self.verify_all = verify_all
+        self.full_scan = full_scan
+        self.engine = engine
+        self.concurrency = concurrency
+        self.registry_workers = registry_workers
+        self.fetch_mode = fetch_mode
+        self.host_backends = host_backends or {}
+        self.host_limits = host_limits or {}
+        self.host_retries = host_retries or {}
+        self.host_tokens = host_tokens or {}
+        self.metrics_file = metrics_file
+        self.metrics_port = metrics_port
+        self.profile_dir = profile_dir
+        self.profile_python = profile_python
+        self.plan_mode = plan_mode
+        self.plan_file = plan_file
+        # (i, n) for the i-th of n shards, counting from 1.
+        self.shard = shard
+        self.merge_shards = merge_shards
+        self.pkg_server = pkg_server
+        self.registry_commits = {}
+        # Packages changed in the registries since the last run, downloaded before the others.
+        self.changed_packages = set()
+        # (registry, package) of the packages whose tarballs failed, scanned again by the next run.
+        self.failed_packages = set()
+        # (registry, package) of the packages removed from the registries, left in place by --plan.
+        self.removed_packages = set()
+        # Parsed registry files of each registry, see `get_toml_cache`.
+        self.toml_caches = {}
+        self.metrics = None
+        self.profiler = None
+        self.downloader = None
+        self.manifest = None
+        self.objects = None
+        self.status_store = None
 
     def __str__(self):
-        return '\n'.join(['%s=%s' % (k, getattr(self, k)) for k in self.__dict__])
+        # Only the number of tokens is shown, so that they do not end up in the logs.
+        values = dict(self.__dict__, host_tokens={k: len(v) for (k, v) in self.host_tokens.items()})
+        return '\n'.join(['%s=%s' % (k, values[k]) for k in values])
+
+    def __getstate__(self):
+        # The downloader owns the pool and cannot be sent to the workers, nor the others with their locks
+        # or their size.
+        state = self.__dict__.copy()
+        for k in ('downloader', 'manifest', 'objects', 'status_store', 'metrics', 'profiler', 'toml_caches'):
+            state[k] = None
+        return state
 
     @property
     def status_file(self):
-        return os.path.join(self.root, 'status.json')
+        return os.path.join(self.root, 'status%s.json' % self.shard_suffix)
+
+    @property
+    def shard_suffix(self):
+        # Each shard keeps its own status and manifest, to be combined by --merge-shards.
+        return '' if self.shard is None else '.shard-%d-of-%d' % self.shard
+
+    @property
+    def cache_dir(self):
+        return os.path.join(self.root, 'cache')
+
+    @property
+    def repos_dir(self):
+        return os.path.join(self.cache_dir, 'repos')
+
+    @property
+    def status_db(self):
+        return os.path.join(self.root, 'status%s.db' % self.shard_suffix)
+
+    @property
+    def manifest_file(self):
+        return os.path.join(self.root, 'manifest%s.json' % self.shard_suffix)
+
+    @property
+    def objects_dir(self):
+        return os.path.join(self.root, 'objects')
 
     @property
     def releases_dir(self):
@@ -68,6 +181,14 @@ class Config(object):
     def packages_dir(self):
         return os.path.join(self.root, 'packages')
 
+    @property
+    def index_dir(self):
+        return os.path.join(self.root, 'index')
+
+    @property
+    def server_dir(self):
+        return os.path.join(self.root, 'server')
+
     @property
     def registries_dir(self):
         return os.path.join(self.root, 'registries')
@@ -112,14 +233,48 @@ def makedir(path):
             raise Exception('%s already exists but is not a directory' % path)
 
 
-def makelink(src, dst, relative=True):
-    if relative:
-        src = os.path.relpath(src, os.path.dirname(dst))
+def set_link(src, dst):
+    # Points the relative link `dst` to `src`, replacing a wrong link or file in one step. A link
+    # that is already right is not touched. Returns whether anything changed.
+    target = os.path.relpath(src, os.path.dirname(dst))
     try:
-        os.symlink(src, dst)
-    except FileExistsError:
-        if not os.path.islink(dst):
+        if os.readlink(dst) == target:
+            return False
+    except FileNotFoundError:
+        pass
+    except OSError:
+        if os.path.isdir(dst):
             raise Exception('%s already exists but is not a link' % dst)
+    tmpfile = dst + '.tmp'
+    if os.path.lexists(tmpfile):
+        os.unlink(tmpfile)
+    os.symlink(target, tmpfile)
+    os.replace(tmpfile, dst)
+    return True
+
+
+def save_json(filename, data, **kwargs):
+    # Write to a temporary file first so that a crash never leaves a truncated file behind.
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as fo:
+        json.dump(data, fo, **kwargs)
+    os.replace(tmpfile, filename)
+
+
+def save_json_gz(filename, data):
+    # Compact and without a timestamp in the gzip header, so that the same data gives the same file.
+    tmpfile = filename + '.tmp'
+    with gzip.GzipFile(tmpfile, 'wb', mtime=0) as fo:
+        fo.write(json.dumps(data, sort_keys=True, separators=(',', ':')).encode())
+    os.replace(tmpfile, filename)
+
+
+def load_json_gz(filename):
+    try:
+        with gzip.open(filename) as fi:
+            return json.load(fi)
+    except (OSError, ValueError):
+        return None
 
 
 # NOTE: Be careful to use this function!
@@ -128,28 +283,262 @@ def cleardir(path):
         os.remove(os.path.join(path, f))
 
 
-def download(config, url, path_or_filename=None, logging_file=None, logging_level=logging.WARNING):
-    set_logging(config)
+def _get_validators(headers):
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified')
+    }
+
+
+def _get_partial_file(url, filename):
+    # Partial downloads are named after the request so that they can be resumed by a later run.
+    partial_dir = os.path.join(tempfile.gettempdir(), 'julia-mirror-partial')
+    makedir(partial_dir)
+    key = hashlib.sha1(('%s\n%s' % (url, filename)).encode()).hexdigest()
+    return os.path.join(partial_dir, key)
+
+
+def _load_partial_info(partial_file):
+    try:
+        with open(partial_file + '.json') as fi:
+            info = json.load(fi)
+        info['size'] = os.path.getsize(partial_file)
+    except (OSError, ValueError):
+        return None
+    return info
+
+
+def _remove_partial(partial_file):
+    for f in (partial_file, partial_file + '.json'):
+        if os.path.exists(f):
+            os.unlink(f)
+
+
+def _get_request_headers(filename, validators, partial_file, token=None):
+    headers = {}
+    if token is not None:
+        headers['Authorization'] = 'Bearer %s' % token
+    # Only ask for a conditional response when there is a file to keep.
+    if validators is not None and os.path.isfile(filename):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    info = _load_partial_info(partial_file)
+    if info is not None and info['size'] > 0 and (info.get('etag') or info.get('last_modified')):
+        headers['Range'] = 'bytes=%d-' % info['size']
+        # The server only sends the rest of the file if it is still the same one.
+        headers['If-Range'] = info.get('etag') or info['last_modified']
+    return headers, info
+
+
+# Raised when the server refuses a request because of its rate limit. The download is not counted
+# as failed: the downloader waits until `reset` (or backs off when it is unknown) and requeues it.
+class RateLimitError(Exception):
+    def __init__(self, url, token, reset):
+        super().__init__(url, token, reset)
+        self.url = url
+        self.token = token
+        self.reset = reset
+
+    def __str__(self):
+        return 'Rate limited: %s' % self.url
+
+
+def _get_reset_time(headers):
+    # Returns the time when requests are allowed again, or `None` if the server does not tell.
+    retry_after = headers.get('Retry-After')
+    if retry_after is not None:
+        if retry_after.isdigit():
+            return time.time() + int(retry_after)
+        try:
+            return email.utils.parsedate_to_datetime(retry_after).timestamp()
+        except (TypeError, ValueError):
+            pass
+    reset = headers.get('X-RateLimit-Reset')
+    if reset is not None and reset.isdigit():
+        return float(reset)
+    return None
+
+
+def _get_rate_limit(headers):
+    # Returns the remaining number of requests and the time when it resets, if the server tells.
+    remaining = headers.get('X-RateLimit-Remaining')
+    if remaining is None or not remaining.isdigit():
+        return None
+    return [int(remaining), _get_reset_time(headers)]
+
+
+class RedirectRecorder(urllib.request.HTTPRedirectHandler):
+    # Keeps the headers of the first redirect, e.g. from the GitHub API to codeload.
+    def __init__(self):
+        self.headers = None
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if self.headers is None:
+            self.headers = headers
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def _check_rate_limit(url, status, headers, token):
+    # GitHub answers 403 instead of 429 when the limit is hit.
+    if status == 429 or (status == 403 and (headers.get('X-RateLimit-Remaining') == '0' or
+                                            headers.get('Retry-After') is not None)):
+        raise RateLimitError(url, token, _get_reset_time(headers))
+
+
+def new_download_stats():
+    # What a download did, reported to the metrics of the run. See `Metrics.add_download`.
+    return {'statuses': {}, 'retries': 0, 'bytes': 0, 'hashed': 0}
+
+
+def _count_response(stats, status, fo=None):
+    if stats is None:
+        return
+    if status is not None:
+        stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+    if fo is not None:
+        stats['bytes'] += fo.written
+        stats['hashed'] += fo.hashed
+
+
+def get_retry_delay(i):
+    return min(Config.RETRY_DELAY * 2 ** i, Config.MAX_RETRY_DELAY)
+
+
+# Computes the sha256 hash of the data while writing it, so the file need not be read again.
+class HashingWriter(object):
+    def __init__(self, filename, mode):
+        self.name = filename
+        self.sha256_hash = hashlib.sha256()
+        self.written = 0
+        self.hashed = 0
+        if mode == 'ab':
+            with open(filename, 'rb') as f:
+                for byte_block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                    self.sha256_hash.update(byte_block)
+                    self.hashed += len(byte_block)
+        self.fo = open(filename, mode)
+
+    def write(self, data):
+        self.sha256_hash.update(data)
+        self.written += len(data)
+        self.hashed += len(data)
+        return self.fo.write(data)
+
+    def close(self):
+        self.fo.close()
+
+    def hexdigest(self):
+        return self.sha256_hash.hexdigest()
+
+
+def _open_partial(url, status, headers, info, partial_file):
+    # Returns the file to write the response body to and the expected size of the whole file.
+    m = re.match(r'^bytes (\d+)-\d+/(\d+|\*)$', headers.get('Content-Range', ''))
+    if status == 206 and info is not None and m is not None and int(m.group(1)) == info['size']:
+        total = None if m.group(2) == '*' else int(m.group(2))
+        if total is not None and info.get('length') not in (None, total):
+            raise http.client.HTTPException('Length of %s changed' % url)
+        logging.info('Resuming %s from byte %d' % (url, info['size']))
+        return HashingWriter(partial_file, 'ab'), total, info
+    if status == 206:
+        raise http.client.HTTPException('Invalid Content-Range: %s' % headers.get('Content-Range'))
+    length = headers.get('Content-Length')
+    total = None if length is None else int(length)
+    info = _get_validators(headers)
+    info['url'] = url
+    info['length'] = total
+    # Without a validator, a partial file can not be safely resumed.
+    if info['etag'] or info['last_modified']:
+        with open(partial_file + '.json', 'w') as fo:
+            json.dump(info, fo)
+    return HashingWriter(partial_file, 'wb'), total, info
+
+
+def _close_partial(url, fo, total, info):
+    fo.close()
+    size = os.path.getsize(fo.name)
+    if total is not None and size != total:
+        raise http.client.HTTPException('Expected %d bytes from %s but got %d' % (total, url, size))
+    return {'etag': info.get('etag'), 'last_modified': info.get('last_modified'), 'sha256': fo.hexdigest()}
+
+
+def _finish_download(result, partial_file, failed, err):
+    url = result['url']
+    filename = result['filename']
+    if failed:
+        # Keep what has been downloaded for the next attempt unless the request itself failed.
+        if isinstance(err, urllib.request.HTTPError) or _load_partial_info(partial_file) is None:
+            _remove_partial(partial_file)
+        logging.error('Failed to download %s' % url)
+        logging.error(err)
+        return None
+    if not result['modified']:
+        _remove_partial(partial_file)
+        logging.info('Not modified: %s' % url)
+        return result
+    # Replace the old file in one step so that it never disappears during the update.
+    shutil.move(partial_file, filename)
+    _remove_partial(partial_file)
+    os.chmod(filename, 0o644)
+    logging.info('Downloaded: %s' % url)
+    return result
+
+
+def _fetch(url, headers, info, partial_file, stats=None):
+    request = urllib.request.Request(url, headers=headers)
+    recorder = RedirectRecorder()
+    with urllib.request.build_opener(recorder).open(request) as response:
+        _count_response(stats, response.status)
+        fo, total, info = _open_partial(url, response.status, response.headers, info, partial_file)
+        try:
+            shutil.copyfileobj(response, fo)
+        finally:
+            fo.close()
+            _count_response(stats, None, fo)
+        # The limits are sent with the redirect from the API rather than the file itself.
+        rate_limit = _get_rate_limit(response.headers if recorder.headers is None else recorder.headers)
+    return dict(_close_partial(url, fo, total, info), rate_limit=rate_limit)
+
+
+def download(config, url, path_or_filename=None, logging_file=None, logging_level=logging.WARNING,
+             validators=None, attempts=3, token=None, stats=None):
     if path_or_filename is None or os.path.isdir(path_or_filename):
         path = os.getcwd() if path_or_filename is None else path_or_filename
         filename = os.path.join(path, url.split('/')[-1])
     else:
         filename = path_or_filename
     logging.info('Downloading %s to %s' % (url, filename))
+    result = {'filename': filename, 'url': url, 'modified': True}
+    partial_file = _get_partial_file(url, filename)
     i = 0
     err = None
-    f = tempfile.NamedTemporaryFile(delete=False)
-    f.close()
-    while i < 3:
+    while i < attempts:
+        if i > 0:
+            time.sleep(get_retry_delay(i - 1))
+            if stats is not None:
+                stats['retries'] += 1
+        headers, info = _get_request_headers(filename, validators, partial_file, token)
         try:
-            urllib.request.urlretrieve(url, f.name)
-            if os.path.isfile(filename):
-                os.unlink(filename)
-            i = 4
+            result.update(_fetch(url, headers, info, partial_file, stats))
+            i = attempts + 1
         except urllib.request.HTTPError as e:
-            err = e
-            i = 3
-        except urllib.request.http.client.HTTPException as e:
+            _count_response(stats, e.code)
+            _check_rate_limit(url, e.code, e.headers, token)
+            if e.code == 304:
+                result['modified'] = False
+                result.update(validators)
+                i = attempts + 1
+            elif e.code == 416:
+                # The partial file is no longer valid, so start over.
+                _remove_partial(partial_file)
+                err = e
+                i += 1
+            else:
+                err = e
+                i = attempts
+        except http.client.HTTPException as e:
             err = e
             i += 1
         except urllib.error.URLError as e:
@@ -158,14 +547,406 @@ def download(config, url, path_or_filename=None, logging_file=None, logging_leve
         except ConnectionError as e:
             err = e
             i += 1
-    if i == 3:
-        os.unlink(f.name)
-        logging.error('Failed to download %s' % url)
-        logging.error(err)
-    else:
-        shutil.move(f.name, filename)
-        os.chmod(filename, 0o644)
-        logging.info('Downloaded: %s' % url)
+    return _finish_download(result, partial_file, i == attempts, err)
+
+
+async def download_async(session, url, filename, validators=None, attempts=3, token=None, stats=None):
+    # Work on whole files, like hashing a partial file again or moving it from another file system,
+    # runs in threads, so that it does not hold up the other downloads.
+    loop = asyncio.get_running_loop()
+    logging.info('Downloading %s to %s' % (url, filename))
+    result = {'filename': filename, 'url': url, 'modified': True}
+    partial_file = _get_partial_file(url, filename)
+    i = 0
+    err = None
+    while i < attempts:
+        if i > 0:
+            await asyncio.sleep(get_retry_delay(i - 1))
+            if stats is not None:
+                stats['retries'] += 1
+        headers, info = _get_request_headers(filename, validators, partial_file, token)
+        try:
+            async with session.get(url, headers=headers) as response:
+                _count_response(stats, response.status)
+                _check_rate_limit(url, response.status, response.headers, token)
+                if response.status == 304:
+                    result['modified'] = False
+                    result.update(validators)
+                    i = attempts + 1
+                    continue
+                if response.status == 416:
+                    _remove_partial(partial_file)
+                    err = urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                    i += 1
+                    continue
+                if response.status >= 400:
+                    err = urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                    i = attempts
+                    continue
+                fo, total, info = await loop.run_in_executor(
+                    None, _open_partial, url, response.status, response.headers, info, partial_file
+                )
+                try:
+                    async for chunk in response.content.iter_chunked(1 << 16):
+                        fo.write(chunk)
+                finally:
+                    fo.close()
+                    _count_response(stats, None, fo)
+                # The limits are sent with the redirect from the API rather than the file itself.
+                rate_limit = _get_rate_limit(response.history[0].headers if response.history else response.headers)
+            result.update(await loop.run_in_executor(None, _close_partial, url, fo, total, info),
+                          rate_limit=rate_limit)
+            i = attempts + 1
+        except (aiohttp.ClientError, asyncio.TimeoutError, http.client.HTTPException) as e:
+            err = e
+            i += 1
+    return await loop.run_in_executor(None, _finish_download, result, partial_file, i == attempts, err)
+
+
+_worker_config = None
+
+
+def _init_worker(config):
+    global _worker_config
+    _worker_config = config
+    set_logging(config)
+    if config.profile_python:
+        profile = cProfile.Profile()
+        profile.enable()
+        # Runs when the worker exits after the pool is closed.
+        filename = os.path.join(config.profile_dir, 'worker-%d.prof' % os.getpid())
+        multiprocessing.util.Finalize(None, _dump_profile, (profile, filename), exitpriority=10)
+
+
+def _dump_profile(profile, filename):
+    profile.disable()
+    profile.dump_stats(filename)
+
+
+def _download_task(url, filename, validators, attempts, token):
+    stats = new_download_stats()
+    result = download(_worker_config, url, filename, validators=validators, attempts=attempts, token=token,
+                      stats=stats)
+    return result, stats
+
+
+def _run_task(func, args):
+    return func(_worker_config, *args)
+
+
+def get_host(url):
+    m = re.match(r'^(?:[a-z+]+://)?(?:[^@/]*@)?([^/:]*)', url)
+    return m.group(1).lower()
+
+
+# Download engines shared by all the phases of a run. Tasks from every caller go into the same
+# queue, so workers never sit idle between small packages. Callbacks run in the main process as
+# soon as their task is done.
+#
+# Each host has its own queue and its own limit of running tasks (see --host-limit), so a slow host
+# can only hold that many workers and never starves the others.
+#
+# Queued jobs are sorted by their priority (lower first, then in the order they were submitted),
+# so whatever matters most is downloaded first whichever package it belongs to.
+#
+# The rate limits told by the servers are kept here for all the workers. Requests to a host rotate
+# through its tokens (see --host-token). When a token runs out, the next one is used, and when all
+# of them have, the host is paused until the first one resets. Downloads refused because of the
+# limit are put back into the queue. Other failed downloads are retried once more after the rest
+# of the queue.
+class Downloader(abc.ABC):
+    def __init__(self, config, workers):
+        self.config = config
+        self.workers = workers
+        # Without --host-limit, a host may use all the workers while no other host has jobs waiting,
+        # and all but a quarter of them otherwise, so that a slow host never holds up the others.
+        self.shared_limit = max(1, workers - max(1, workers // 4))
+        self.pending = 0
+        self.queues = {}
+        self.running = {}
+        self.paused = {}
+        self.timers = {}
+        # For each host, the tokens with the time until which each of them is used up.
+        self.tokens = {
+            host: collections.deque([token, 0] for token in tokens)
+            for (host, tokens) in config.host_tokens.items()
+        }
+        self.counter = itertools.count()
+        self.metrics = config.metrics
+        self.condition = threading.Condition()
+
+    def get_limit(self, host):
+        # Called with the condition held.
+        if host in self.config.host_limits:
+            return self.config.host_limits[host]
+        if any(queue for (other, queue) in self.queues.items() if other != host):
+            return self.shared_limit
+        return self.workers
+
+    def submit(self, url, filename, callback=None, validators=None, host=None, priority=()):
+        if host is None:
+            host = get_host(url)
+        attempts = self.config.host_retries.get(host, 2) + 1
+        self._enqueue(host, _Job((url, filename, validators, attempts), callback, True, priority,
+                                 self.metrics.phase))
+
+    def submit_task(self, func, args, callback=None, host=None, priority=()):
+        # Runs `func(config, *args)` in a worker. It must be a module level function.
+        self._enqueue(host, _Job((func, args), callback, False, priority, self.metrics.phase))
+
+    def _enqueue(self, host, job):
+        with self.condition:
+            self.pending += 1
+            self._push(host, job)
+        self._dispatch(host)
+
+    def _push(self, host, job):
+        # Called with the condition held.
+        heapq.heappush(self.queues.setdefault(host, []), (job.priority, next(self.counter), job))
+        self.metrics.set('queue_depth', len(self.queues[host]), host=host)
+
+    def _get_token(self, host, now):
+        # Returns the token for the next request to `host` and the seconds to wait before it can
+        # be sent. The token is `None` if there is none for this host.
+        tokens = self.tokens.get(host)
+        if not tokens:
+            return None, 0
+        for _ in range(len(tokens)):
+            tokens.rotate(-1)
+            if tokens[0][1] <= now:
+                return tokens[0][0], 0
+        return None, min(t[1] for t in tokens) - now
+
+    def _pause(self, host, until):
+        # Called with the condition held.
+        self.paused[host] = max(self.paused.get(host, 0), until)
+        if host not in self.timers:
+            timer = threading.Timer(until - time.time(), self._resume, (host,))
+            timer.daemon = True
+            self.timers[host] = timer
+            timer.start()
+
+    def _resume(self, host):
+        with self.condition:
+            del self.timers[host]
+        self._dispatch(host)
+
+    def _dispatch(self, host):
+        while True:
+            with self.condition:
+                queue = self.queues.get(host)
+                if not queue or self.running.get(host, 0) >= self.get_limit(host):
+                    return
+                now = time.time()
+                if self.paused.get(host, 0) > now:
+                    self._pause(host, self.paused[host])
+                    return
+                token = None
+                if queue[0][2].is_download:
+                    token, wait = self._get_token(host, now)
+                    if wait > 0:
+                        self._pause(host, now + wait)
+                        return
+                job = heapq.heappop(queue)[2]
+                self.running[host] = self.running.get(host, 0) + 1
+                self.metrics.set('queue_depth', len(queue), host=host)
+            done = functools.partial(self._done, host, job, token)
+            if job.is_download:
+                self._submit(*job.args, token, done)
+            else:
+                self._submit_task(*job.args, done)
+
+    @abc.abstractmethod
+    def _submit(self, url, filename, validators, attempts, token, done):
+        pass
+
+    @abc.abstractmethod
+    def _submit_task(self, func, args, done):
+        pass
+
+    def _limit(self, host, token, reset, requeues):
+        # Called with the condition held, when the limit of `token` (or of the host, when there is
+        # no token) has been reached.
+        now = time.time()
+        if reset is None or reset <= now:
+            reset = now + get_retry_delay(requeues)
+        tokens = self.tokens.get(host)
+        if token is not None and tokens:
+            for t in tokens:
+                if t[0] == token:
+                    t[1] = max(t[1], reset)
+        else:
+            self._pause(host, reset)
+
+    def _requeue(self, host, job, err):
+        # Returns whether the job has been put back into the queue instead of being finished.
+        if not job.is_download:
+            return False
+        with self.condition:
+            if isinstance(err, RateLimitError):
+                self._limit(host, err.token, err.reset, job.requeues)
+                if job.requeues >= Config.MAX_REQUEUES:
+                    return False
+                logging.warning('%s, waiting to retry.' % err)
+                job.requeues += 1
+                # Rate limited downloads keep their priority.
+                self._push(host, job)
+                return True
+            if job.failed:
+                return False
+            logging.warning('Retrying %s later.' % job.args[0])
+            job.failed = True
+            job.priority = (float('inf'),)
+            self._push(host, job)
+            return True
+
+    def _done(self, host, job, token, result, err=None):
+        with self.condition:
+            self.running[host] -= 1
+        if job.is_download and err is None:
+            result, stats = result
+            self.metrics.add_download(job.phase, stats)
+        elif isinstance(err, RateLimitError):
+            self.metrics.inc('rate_limited', phase=job.phase, host=host)
+        if isinstance(result, dict):
+            rate_limit = result.pop('rate_limit', None)
+            if rate_limit is not None and rate_limit[0] == 0:
+                with self.condition:
+                    self._limit(host, token, rate_limit[1], 0)
+        if (isinstance(err, RateLimitError) or (result is None and err is None)) and self._requeue(host, job, err):
+            self._dispatch(host)
+            return
+        try:
+            if err is not None:
+                logging.error(err)
+            if job.is_download:
+                self.metrics.count_file(job.phase, result)
+            if job.callback is not None:
+                job.callback(result)
+        except Exception as e:
+            # An exception here would kill the thread handling the results.
+            logging.error('Failed to process the result of a download')
+            logging.error(e)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+            self._dispatch(host)
+
+    def wait(self):
+        with self.condition:
+            while self.pending > 0:
+                self.condition.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _Job(object):
+    def __init__(self, args, callback, is_download, priority, phase):
+        self.args = args
+        self.callback = callback
+        self.is_download = is_download
+        self.priority = priority
+        self.phase = phase
+        self.requeues = 0
+        self.failed = False
+
+
+# Downloads with urllib in a pool of processes.
+class ProcessDownloader(Downloader):
+    def __init__(self, config):
+        super().__init__(config, config.max_processes)
+        self.pool = multiprocessing.pool.Pool(config.max_processes, _init_worker, (config,))
+
+    def _submit(self, url, filename, validators, attempts, token, done):
+        self.pool.apply_async(
+            _download_task, (url, filename, validators, attempts, token),
+            callback=done, error_callback=lambda err: done(None, err)
+        )
+
+    def _submit_task(self, func, args, done):
+        self.pool.apply_async(
+            _run_task, (func, args),
+            callback=done, error_callback=lambda err: done(None, err)
+        )
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.wait()
+            self.pool.close()
+        else:
+            self.pool.terminate()
+        self.pool.join()
+
+
+# Downloads with aiohttp in an event loop running in a background thread. Connections are kept
+# alive and reused for each host, which matters much more than bandwidth for small tarballs.
+class AsyncDownloader(Downloader):
+    def __init__(self, config):
+        if aiohttp is None:
+            raise Exception('aiohttp is required for --engine async')
+        super().__init__(config, config.concurrency)
+        # Blocking tasks like git commands run in threads.
+        self.executor = concurrent.futures.ThreadPoolExecutor(config.max_processes)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=profiled(config, self.loop.run_forever), daemon=True)
+        self.thread.start()
+        self.semaphore = None
+        self.session = asyncio.run_coroutine_threadsafe(self._start(config.concurrency), self.loop).result()
+
+    async def _start(self, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        # Large release binaries may take longer than the default total timeout.
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+        # Files are saved exactly as they are served, like with urllib.
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False,
+                                     headers={'Accept-Encoding': 'identity'})
+
+    async def _download(self, url, filename, validators, attempts, token, done):
+        result = err = None
+        stats = new_download_stats()
+        try:
+            async with self.semaphore:
+                result = await download_async(self.session, url, filename, validators, attempts, token, stats)
+        except Exception as e:
+            err = e
+        done(None if err is not None else (result, stats), err)
+
+    def _submit(self, url, filename, validators, attempts, token, done):
+        asyncio.run_coroutine_threadsafe(
+            self._download(url, filename, validators, attempts, token, done), self.loop
+        )
+
+    def _run(self, func, args, done):
+        result = err = None
+        try:
+            result = func(self.config, *args)
+        except Exception as e:
+            err = e
+        done(result, err)
+
+    def _submit_task(self, func, args, done):
+        self.executor.submit(profiled(self.config, self._run), func, args, done)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.wait()
+        self.executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+DOWNLOADERS = {
+    'process': ProcessDownloader,
+    'async': AsyncDownloader
+}
 
 
 def get_config():
@@ -189,17 +970,76 @@ def get_config():
                         help='add a registry specified by a custom URL')
     parser.add_argument('--max-processes', type=int, default=4, metavar='N',
                         help='use up to N processes for downloading (default: 4)')
+    parser.add_argument('--registry-workers', type=int, default=4, metavar='N',
+                        help='update up to N registries at the same time (default: %(default)s)')
+    parser.add_argument('--engine', type=str, choices=list(DOWNLOADERS.keys()), default='process',
+                        help='download with a pool of processes or with asyncio in one process, '
+                             'which requires aiohttp (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=64, metavar='N',
+                        help='run up to N concurrent requests with --engine async (default: %(default)s)')
+    parser.add_argument('--fetch-mode', type=str, choices=['tarball', 'git'], default='tarball',
+                        help='download package tarballs from the host when it is supported, or always keep '
+                             'a bare mirror of each package repository and make them with git archive '
+                             '(default: %(default)s)')
+    parser.add_argument('--host-backend', type=str, nargs=2, action='append', default=[],
+                        metavar=('HOST', '{%s}' % ','.join(FETCHERS)),
+                        help='fetch packages on HOST with the given backend')
+    parser.add_argument('--host-limit', type=str, nargs=2, action='append', default=[],
+                        metavar=('HOST', 'N'),
+                        help='run up to N downloads from HOST at the same time (default: all of '
+                             '--max-processes, or of --concurrency with --engine async, and three '
+                             'quarters of them while other hosts have downloads waiting)')
+    parser.add_argument('--host-retries', type=str, nargs=2, action='append', default=[],
+                        metavar=('HOST', 'N'),
+                        help='retry a failed download from HOST up to N times (default: 2)')
+    parser.add_argument('--host-token', type=str, nargs=2, action='append', default=[],
+                        metavar=('HOST', 'TOKEN'),
+                        help='send TOKEN with the requests to HOST, rotating through the tokens given '
+                             'for it when their rate limits are reached (the GITHUB_TOKEN environment '
+                             'variable is used for github.com)')
     parser.add_argument('--sync-latest-packages', action='store_true',
                         help='also mirror packages on master branch')
     parser.add_argument('--ignore-invalid-registry', action='store_true',
                         help='ignore when a registry is not valid')
+    parser.add_argument('--full-scan', action='store_true',
+                        help='scan all the packages in the registries instead of only the changed ones')
+    parser.add_argument('--verify-all', action='store_true',
+                        help='re-hash all the existing package tarballs instead of trusting the manifest, '
+                             'and download again those that do not match their .sha256 files')
     parser.add_argument('--temp-dir', type=str, default=None,
-                        help='directory for saving temporary files')
+                        help='directory for saving temporary and partially downloaded files')
     parser.add_argument('--logging-file', type=str, default=None,
                         help='save log to a file instead of to STDOUT')
     parser.add_argument('--logging-level', type=lambda x: str(x).upper(),
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
                         default='WARNING', help='set logging level (default: %(default)s)')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='write Prometheus metrics of the run to this file after each phase, e.g. for '
+                             'the textfile collector of the node exporter')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on http://0.0.0.0:PORT/metrics while running')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--plan', type=str, default=None, metavar='FILE',
+                       help='update the registries and save what would be downloaded, with the estimated '
+                            'sizes, to FILE as JSON without downloading it')
+    group.add_argument('--execute', type=str, default=None, metavar='FILE',
+                       help='download the releases and packages listed in a plan saved by --plan')
+    parser.add_argument('--shard', type=str, default=None, metavar='I/N',
+                        help='only update the registries and download the packages in the I-th of N parts '
+                             '(counting from 1), with its own status and manifest, so that N machines can '
+                             'share the work')
+    parser.add_argument('--merge-shards', action='store_true',
+                        help='combine the statuses and manifests of the shards in the mirror and verify '
+                             'the package tarballs, after their files are copied into one tree, then '
+                             'update the client, releases and METADATA.jl')
+    parser.add_argument('--pkg-server', action='store_true',
+                        help='also write the registries and packages in the layout of the Pkg server '
+                             'protocol to server/, for Pkg clients to use a static web server')
+    parser.add_argument('--profile', type=str, default=None, metavar='DIR',
+                        help='save the wall and CPU time of each phase to DIR')
+    parser.add_argument('--profile-python', action='store_true',
+                        help='with --profile, also profile the functions with cProfile, including in the '
+                             'download workers, and report the hottest ones')
     parser.add_argument('--mirror-name', type=str, default=socket.gethostname(),
                         help='name of this mirror (default: %(default)s)')
     args = parser.parse_args()
@@ -211,6 +1051,36 @@ def get_config():
         if name in registries:
             raise Exception('duplicated name for custom registry: %s' % name)
         registries[name] = url
+    for (host, backend) in args.host_backend:
+        if backend not in FETCHERS:
+            raise Exception('unknown backend for %s: %s' % (host, backend))
+    host_backends = {host.lower(): backend for (host, backend) in args.host_backend}
+    for (host, n) in args.host_limit:
+        if not n.isdigit() or int(n) < 1:
+            raise Exception('--host-limit must be at least 1 for %s: %s' % (host, n))
+    host_limits = {host.lower(): int(n) for (host, n) in args.host_limit}
+    host_retries = {host.lower(): int(n) for (host, n) in args.host_retries}
+    host_tokens = {}
+    if os.environ.get('GITHUB_TOKEN'):
+        host_tokens['github.com'] = [os.environ['GITHUB_TOKEN']]
+    for (host, token) in args.host_token:
+        host_tokens.setdefault(host.lower(), []).append(token)
+    if args.profile_python and args.profile is None:
+        raise Exception('--profile-python must be used with --profile')
+    shard = None
+    if args.shard is not None:
+        m = re.match(r'^(\d+)/(\d+)$', args.shard)
+        if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+            raise Exception('--shard must be like 1/4: %s' % args.shard)
+        shard = (int(m.group(1)), int(m.group(2)))
+    if shard is not None and args.merge_shards:
+        raise Exception('--merge-shards must not be used with --shard')
+    if args.plan is not None:
+        (plan_mode, plan_file) = ('plan', args.plan)
+    elif args.execute is not None:
+        (plan_mode, plan_file) = ('execute', args.execute)
+    else:
+        (plan_mode, plan_file) = (None, None)
     if len(registries) == 0:
         args.no_packages = True
     if args.no_packages and args.sync_latest_packages:
@@ -220,7 +1090,13 @@ def get_config():
     config = Config(
         root, not args.no_releases, not args.no_metadata, not args.no_packages, registries,
         args.sync_latest_packages, args.max_processes, args.ignore_invalid_registry,
-        args.temp_dir, (args.logging_file, args.logging_level), args.mirror_name
+        args.temp_dir, (args.logging_file, args.logging_level), args.mirror_name,
+        args.verify_all, args.full_scan, args.engine, args.concurrency, args.registry_workers,
+        args.fetch_mode, host_backends, host_limits, host_retries, host_tokens,
+        None if args.metrics_file is None else os.path.abspath(args.metrics_file), args.metrics_port,
+        None if args.profile is None else os.path.abspath(args.profile), args.profile_python,
+        plan_mode, None if plan_file is None else os.path.abspath(plan_file), shard, args.merge_shards,
+        args.pkg_server
     )
     set_logging(config)
     logging.info('Running with settings:\n%s' % config)
@@ -232,22 +1108,270 @@ def _get_current_time():
     return now.strftime(Config.DATEFMT)
 
 
-def save_status(config, status, name=None, registry_name=None):
-    status['last_updated'] = _get_current_time()
-    if name is not None:
-        status[name]['last_updated'] = status['last_updated']
+# Keeps each top-level section of the status as a row in SQLite, so that saving the status only
+# writes the changed sections in one transaction. status.json is exported from it from time to time.
+class StatusStore(object):
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS status (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.lock = threading.RLock()
+        self.last_export = 0
+
+    def load(self):
+        with self.lock:
+            rows = self.db.execute('SELECT key, value FROM status').fetchall()
+        if len(rows) == 0:
+            return None
+        return {key: json.loads(value) for (key, value) in rows}
+
+    def save(self, status, keys):
+        with self.lock:
+            rows = [(key, json.dumps(status[key], sort_keys=True)) for key in keys]
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)', rows)
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def export(self, status, filename):
+        with self.lock:
+            save_json(filename, status, indent=4, sort_keys=True)
+            self.last_export = time.monotonic()
+
+    def close(self):
+        self.db.close()
+
+
+# Counters and gauges of a run, labeled by the phase they belong to, in the text format of
+# Prometheus. They are written to --metrics-file for the textfile collector of the node exporter
+# and served on --metrics-port while the mirror is running.
+class Metrics(object):
+    PREFIX = 'julia_mirror_'
+    TYPES = {
+        'phase_duration_seconds': ('gauge', 'Duration of the last run of each phase.'),
+        'phase_success': ('gauge', 'Whether the last run of each phase succeeded.'),
+        'phase_last_run_timestamp_seconds': ('gauge', 'Time when each phase last finished.'),
+        'files_total': ('counter', 'Files handled, by result (downloaded, not_modified, skipped or failed).'),
+        'bytes_downloaded_total': ('counter', 'Bytes received from the servers.'),
+        'bytes_hashed_total': ('counter', 'Bytes read to compute sha256 hashes.'),
+        'retries_total': ('counter', 'Requests sent again after a failure.'),
+        'rate_limited_total': ('counter', 'Requests refused because of the rate limit of the server.'),
+        'http_responses_total': ('counter', 'HTTP responses by status code.'),
+        'queue_depth': ('gauge', 'Jobs waiting in the download queue of each host.'),
+    }
 
-    if registry_name is not None:
-        status['registries']['registries'][registry_name]['last_updated'] = _get_current_time()
-    with open(config.status_file, 'w') as fo:
-        json.dump(status, fo, indent=4, sort_keys=True)
+    def __init__(self):
+        self.values = {}
+        self.phase = None
+        self.phase_start = None
+        self.lock = threading.Lock()
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        name = name + '_total'
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def start_phase(self, phase):
+        self.phase = phase
+        self.phase_start = time.monotonic()
+
+    def end_phase(self, success):
+        phase = self.phase
+        self.set('phase_duration_seconds', time.monotonic() - self.phase_start, phase=phase)
+        self.set('phase_success', 1 if success else 0, phase=phase)
+        self.set('phase_last_run_timestamp_seconds', time.time(), phase=phase)
+        self.phase = None
+
+    def add_download(self, phase, stats):
+        for (code, n) in stats['statuses'].items():
+            self.inc('http_responses', n, phase=phase, code=str(code))
+        self.inc('retries', stats['retries'], phase=phase)
+        self.inc('bytes_downloaded', stats['bytes'], phase=phase)
+        self.inc('bytes_hashed', stats['hashed'], phase=phase)
+
+    def count_file(self, phase, result):
+        if result is None:
+            self.inc('files', phase=phase, result='failed')
+        else:
+            self.inc('files', phase=phase, result='downloaded' if result['modified'] else 'not_modified')
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        for name in sorted(set(name for ((name, labels), value) in values)):
+            (metric_type, description) = self.TYPES[name]
+            lines.append('# HELP %s%s %s' % (self.PREFIX, name, description))
+            lines.append('# TYPE %s%s %s' % (self.PREFIX, name, metric_type))
+            for ((each, labels), value) in values:
+                if each != name:
+                    continue
+                label_text = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for (k, v) in labels)
+                lines.append('%s%s%s %s' % (self.PREFIX, name, '{%s}' % label_text if label_text else '', value))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, filename):
+        # The collector must never read a partial file.
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as fo:
+            fo.write(self.render())
+        os.replace(tmpfile, filename)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(config):
+    server = http.server.ThreadingHTTPServer(('', config.metrics_port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = config.metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info('Serving metrics on port %d' % config.metrics_port)
+    return server
+
+
+# Records the wall and CPU time of each phase for --profile. With --profile-python, cProfile data is
+# also captured in the main thread, in the threads started through `profiled` and in the download
+# workers, and merged into one report of the hottest functions.
+class Profiler(object):
+    def __init__(self, path, python):
+        self.path = path
+        self.python = python
+        self.phases = []
+        self.current = None
+        self.profiles = []
+        self.lock = threading.Lock()
+        makedir(path)
+        for filename in glob.glob(os.path.join(path, 'worker-*.prof')):
+            os.unlink(filename)
+        self.main = None
+        if python:
+            self.main = cProfile.Profile()
+            self.main.enable()
+
+    @staticmethod
+    def _get_times():
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.monotonic(), time.process_time(), children.ru_utime + children.ru_stime
+
+    def start_phase(self, name):
+        self.current = (name, self._get_times())
+
+    def end_phase(self, success):
+        (name, start) = self.current
+        end = self._get_times()
+        self.phases.append({
+            'phase': name,
+            'success': success,
+            'wall_seconds': end[0] - start[0],
+            'cpu_seconds': end[1] - start[1],
+            # Git commands, and the download workers once their pool is closed.
+            'children_cpu_seconds': end[2] - start[2]
+        })
+        self.current = None
+
+    def wrap(self, func):
+        if not self.python:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Only one profiler can be active at a time since Python 3.12.
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.profiles.append(profile)
+        return wrapper
+
+    def save(self, top=30):
+        save_json(os.path.join(self.path, 'phases.json'), self.phases, indent=4)
+        lines = ['%-12s %10s %10s %14s  %s' % ('phase', 'wall (s)', 'cpu (s)', 'children (s)', 'status')]
+        for each in self.phases:
+            lines.append('%-12s %10.2f %10.2f %14.2f  %s' % (
+                each['phase'], each['wall_seconds'], each['cpu_seconds'], each['children_cpu_seconds'],
+                'ok' if each['success'] else 'failed'
+            ))
+        report = os.path.join(self.path, 'report.txt')
+        with open(report, 'w') as fo:
+            fo.write('\n'.join(lines) + '\n')
+            if self.python:
+                self.main.disable()
+                workers = glob.glob(os.path.join(self.path, 'worker-*.prof'))
+                stats = pstats.Stats(self.main, *self.profiles, *workers, stream=fo)
+                stats.dump_stats(os.path.join(self.path, 'merged.prof'))
+                fo.write('\nMerged from the main process, %d threads and %d workers.\n' % (
+                    len(self.profiles), len(workers)))
+                for sort_key in ('cumulative', 'tottime'):
+                    fo.write('\nTop %d functions by %s time:\n' % (top, sort_key))
+                    stats.sort_stats(sort_key).print_stats(top)
+        logging.info('Profile saved to %s' % report)
+
+
+def profiled(config, func):
+    return func if config.profiler is None else config.profiler.wrap(func)
+
+
+def save_status(config, status, name=None, registry_name=None, export=False):
+    store = config.status_store
+    with store.lock:
+        status['last_updated'] = _get_current_time()
+        if name is not None:
+            status[name]['last_updated'] = status['last_updated']
+
+        if registry_name is not None:
+            status['registries']['registries'][registry_name]['last_updated'] = _get_current_time()
+        if name is None and registry_name is None:
+            keys = list(status.keys())
+        else:
+            keys = set(['last_updated', name or 'registries'])
+            if registry_name is not None:
+                keys.add('registries')
+        store.save(status, keys)
+        if export or time.monotonic() - store.last_export >= Config.STATUS_EXPORT_INTERVAL:
+            store.export(status, config.status_file)
 
 
 def get_current_status(config):
-    if not os.path.exists(config.status_file):
+    status = config.status_store.load()
+    if status is None and os.path.exists(config.status_file):
+        # Status saved by older versions.
+        with open(config.status_file) as fi:
+            status = json.load(fi)
+    if status is None:
         return None
-    with open(config.status_file) as fi:
-        status = json.load(fi)
     status_config = status.get('config', {})
     for arg in Config.SETTINGS:
         v1 = status_config.get(arg)
@@ -255,6 +1379,7 @@ def get_current_status(config):
         if v1 != v2:
             logging.warning('Setting %s changed from %s to %s.' % (arg, v1, v2))
             status_config[arg] = v2
+            config.full_scan = True
     status['config'] = status_config
     return status
 
@@ -274,24 +1399,62 @@ def initialize(config, status):
     set_status('packages', {'status': 'unavailable'})
     set_status('mirror_version', VERSION, True)
     set_status('client', {'status': 'unavailable'})
-    save_status(config, status)
+    set_status('server', {'status': 'unavailable'})
+    save_status(config, status, export=True)
     return get_current_status(config)
 
 
-def download_all(config, path, urllist):
-    with multiprocessing.pool.Pool(config.max_processes) as pool:
-        pool.starmap(download, ((config, url, os.path.join(path, filename))
-                                for (filename, url) in urllist))
+def download_all(config, path, urllist, callback=None, validators=None):
+    # Only queues the downloads. Use `config.downloader.wait()` to wait for them.
+    if validators is None:
+        validators = {}
+    for (filename, url) in urllist:
+        config.downloader.submit(url, os.path.join(path, filename), callback, validators.get(filename))
 
 
-def fetch_releaseinfo(config, status):
-    download(config, Config.REMOTE_RELEASEINFO, config.releaseinfo_file)
-    with open(config.releaseinfo_file) as fi:
+def _save_validators(validators, result):
+    if result is not None:
+        validators[os.path.basename(result['filename'])] = {
+            'etag': result.get('etag'),
+            'last_modified': result.get('last_modified')
+        }
+
+
+def remove_stale_files(path, urllist):
+    filenames = set(filename for (filename, url) in urllist)
+    for f in os.listdir(path):
+        if f not in filenames:
+            logging.info('Removing stale file %s' % os.path.join(path, f))
+            os.remove(os.path.join(path, f))
+
+
+def fetch_releaseinfo(config, status, filename=None):
+    if filename is None:
+        filename = config.releaseinfo_file
+    download(config, Config.REMOTE_RELEASEINFO, filename)
+    with open(filename) as fi:
         meta = json.load(fi)
     return meta
 
 
-def update_releases(config, status):
+def get_stale_releases(config, s, meta):
+    # Returns the versions of the Julia releases that need to be synchronized.
+    stale = []
+    for version in meta['versions']:
+        mv = meta['versions'][version]
+        version_dir = os.path.join(config.releases_dir, version)
+        if version == 'latest':
+            stale.append(version)
+            continue
+        sv = s.get(version)
+        if sv is None or sv.get('subversion') != mv['subversion'] or sv.get('last_updated') is None:
+            stale.append(version)
+        elif not os.path.isdir(version_dir) or len(os.listdir(version_dir)) != len(mv['urllist']):
+            stale.append(version)
+    return stale
+
+
+def update_releases(config, status, meta=None, versions=None):
     s = status['releases']
     if s.get('created_time') is None:
         s = status['releases'] = {
@@ -301,28 +1464,32 @@ def update_releases(config, status):
     logging.info('Updating mirror for Julia releases.')
     s['status'] = 'synchronizing'
     save_status(config, status, 'releases')
-    logging.info('Fetching releaseinfo.json')
-    meta = fetch_releaseinfo(config, status)
-    for version in meta['versions']:
-        need_update = False
+    if meta is None:
+        logging.info('Fetching releaseinfo.json')
+        meta = fetch_releaseinfo(config, status)
+    else:
+        # Given by a plan with the versions to update, see `execute_plan`.
+        save_json(config.releaseinfo_file, meta)
+    if versions is None:
+        versions = get_stale_releases(config, s, meta)
+    for version in versions:
         mv = meta['versions'][version]
         version_dir = os.path.join(config.releases_dir, version)
         makedir(version_dir)
-        if version == 'latest':
-            need_update = True
-        else:
-            sv = s.get(version)
-            if sv is None or sv.get('subversion') != mv['subversion'] or sv.get('last_updated') is None:
-                need_update = True
-            elif len(os.listdir(version_dir)) != len(mv['urllist']):
-                need_update = True
-        if not need_update:
-            continue
-        cleardir(version_dir)
+        # Files are replaced one by one instead of clearing the directory first, so that the
+        # directory is never empty while synchronizing. Unchanged files are kept by conditional
+        # requests.
+        validators = s.get(version, {}).get('validators', {})
         s[version] = {
-            'subversion': 'latest' if version == 'latest' else mv['subversion']
+            'subversion': 'latest' if version == 'latest' else mv['subversion'],
+            'validators': validators
         }
-        download_all(config, version_dir, mv['urllist'])
+        download_all(config, version_dir, mv['urllist'],
+                     functools.partial(_save_validators, validators), validators)
+        config.downloader.wait()
+        remove_stale_files(version_dir, mv['urllist'])
+        for filename in [f for f in validators if not os.path.exists(os.path.join(version_dir, f))]:
+            del validators[filename]
         s[version]['last_updated'] = _get_current_time()
         save_status(config, status, 'releases')
     s['status'] = 'updated'
@@ -330,10 +1497,13 @@ def update_releases(config, status):
     logging.info('Releases mirror update completed.')
 
 
-def clone_from(url, to, mirror=False, shallow=True):
+def clone_from(url, to, mirror=False, shallow=True, shared=False):
     tempdir = tempfile.mkdtemp()
     if mirror:
         repo = git.Repo.clone_from(url, tempdir, mirror=True)
+    elif shared:
+        # Borrows the objects of a local repository through alternates instead of copying them.
+        repo = git.Repo.clone_from(url, tempdir, shared=True)
     elif shallow:
         repo = git.Repo.clone_from(url, tempdir, depth=1, shallow_submodules=True)
     else:
@@ -357,6 +1527,24 @@ def update_repo(repo, mirror=False):
         repo.remotes.origin.pull()
 
 
+def share_objects(repo, mirror_dir):
+    # Working trees cloned by older versions have their own copy of every object. Point them at
+    # the objects of the bare mirror and drop the copies.
+    alternates = os.path.join(repo.git_dir, 'objects', 'info', 'alternates')
+    if os.path.exists(alternates):
+        return
+    logging.info('Sharing objects of %s with %s' % (repo.working_dir, mirror_dir))
+    with open(alternates, 'w') as fo:
+        fo.write(os.path.join(os.path.abspath(mirror_dir), 'objects') + '\n')
+    repo.git.repack('-a', '-d', '-l')
+
+
+def update_working_tree(repo, mirror_repo):
+    # The bare mirror has already fetched the updates and the working tree can read its objects,
+    # so a local checkout is enough. Untracked files like the releases links are kept.
+    repo.git.reset('--hard', mirror_repo.head.commit.hexsha)
+
+
 def update_metadata(config, status):
     s = status['metadata']
     if s.get('created_time') is None:
@@ -373,31 +1561,98 @@ def update_metadata(config, status):
         clone_from(Config.METADATA_URL, mirror_dir, True)
     if not os.path.exists(os.path.join(config.metadata_dir, '.git')):
         logging.info('Cloning to a working tree.')
-        clone_from(mirror_dir, config.metadata_dir, False, False)
+        clone_from(mirror_dir, config.metadata_dir, False, False, True)
     logging.info('Loading information in METADATA.jl')
     mirror_repo = git.Repo(mirror_dir)
     repo = git.Repo(config.metadata_dir)
     logging.info('Fetching updates from upstream')
+    share_objects(repo, mirror_dir)
     update_repo(mirror_repo, True)
-    update_repo(repo, False)
+    update_working_tree(repo, mirror_repo)
     s['status'] = 'updated'
     save_status(config, status, 'metadata')
     logging.info('Metadata mirror update completed.')
 
 
-def get_package_info(package_dir):
-    package_file = os.path.join(package_dir, 'Package.toml')
-    if not os.path.isfile(package_file):
-        return None
-    with open(package_file) as fi:
-        package_info = toml.load(fi)
-    return package_info
-
-
-def get_version_list(package_dir):
-    with open(os.path.join(package_dir, 'Versions.toml')) as fi:
-        version_list = toml.load(fi)
-    return version_list
+# Parses the TOML files of a registry straight from the git object database. The parsed files are
+# cached on disk by blob id, so a file that has not changed is never read or parsed again.
+class TomlCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as fi:
+                    self.entries = json.load(fi)
+            except ValueError:
+                logging.warning('Ignoring broken cache file %s' % filename)
+
+    def load(self, repo, blob_sha):
+        if blob_sha not in self.entries:
+            data = repo.odb.stream(bytes.fromhex(blob_sha)).read()
+            self.entries[blob_sha] = toml.loads(data.decode('utf-8'))
+            self.changed = True
+        return self.entries[blob_sha]
+
+    def save(self, blob_shas):
+        # Only the files of the commit in `blob_shas` are kept. Nothing is written if nothing changed.
+        if len(self.entries) != len(blob_shas) or any(k not in blob_shas for k in self.entries):
+            self.entries = {k: v for (k, v) in self.entries.items() if k in blob_shas}
+            self.changed = True
+        if not self.changed:
+            return
+        makedir(os.path.dirname(self.filename))
+        save_json(self.filename, self.entries)
+        self.changed = False
+
+
+def get_toml_cache(config, registry_name):
+    # The cache of a registry is loaded once per run, and shared by the phases after the registries.
+    if registry_name not in config.toml_caches:
+        config.toml_caches[registry_name] = TomlCache(
+            os.path.join(config.cache_dir, 'registries', registry_name + '.json')
+        )
+    return config.toml_caches[registry_name]
+
+
+def get_registry_files(repo, commit):
+    # Returns the blob ids of Package.toml and Versions.toml in each package directory.
+    files = {}
+    for line in repo.git.ls_tree('-r', commit).splitlines():
+        meta, path = line.split('\t', 1)
+        parts = path.split('/')
+        if len(parts) == 3 and parts[2] in ('Package.toml', 'Versions.toml'):
+            files.setdefault('%s/%s/' % (parts[0], parts[1]), {})[parts[2]] = meta.split()[2]
+    return files
+
+
+def has_registry(config, registry_name):
+    # Whether the bare mirror and the working tree of a registry are in this root. They are not when
+    # --execute runs a plan on a root that never synchronized the registries.
+    registry_dir = os.path.join(config.registries_dir, registry_name)
+    return os.path.isdir(registry_dir + '.git') and os.path.isdir(os.path.join(registry_dir, '.git'))
+
+
+def read_registry_packages(registry_dir, cache):
+    # Returns {package_name: package_info} of a registry at the commit of its working tree, read
+    # from its bare mirror, like `update_package_list` in a full scan.
+    mirror_repo = git.Repo(registry_dir + '.git')
+    commit = git.Repo(registry_dir).head.commit.hexsha
+    packages = {}
+    for (each_dir, blobs) in get_registry_files(mirror_repo, commit).items():
+        if 'Package.toml' in blobs:
+            package_info = dict(cache.load(mirror_repo, blobs['Package.toml']))
+            versions_blob = blobs.get('Versions.toml')
+            package_info['versions'] = {} if versions_blob is None else cache.load(mirror_repo, versions_blob)
+            packages[each_dir.split('/')[1]] = package_info
+    return packages
+
+
+def read_registry_versions(registry_dir, cache):
+    # Returns {package_name: versions}, see `read_registry_packages`.
+    packages = read_registry_packages(registry_dir, cache)
+    return {package_name: package_info['versions'] for (package_name, package_info) in packages.items()}
 
 
 def remove_empty_dir(dirname):
@@ -424,50 +1679,104 @@ def delete_package(config, package_name, registry_name):
         remove_empty_dir(package_dir)
 
 
-def update_package_list(config, registry_name, registry_dir):
-    packages = config.packages
-    for each_dir in glob.glob(os.path.join(registry_dir, '*/*/')):
-        package_name = os.path.basename(each_dir[:-1])
-        package_info = get_package_info(each_dir)
-        if package_info is None:
-            delete_package(config, package_name, registry_name)
+def get_changed_dirs(repo, old_commit, new_commit):
+    try:
+        repo.git.cat_file('-e', old_commit + '^{commit}')
+    except git.GitCommandError:
+        logging.warning('Commit %s is not found, scanning the whole registry.' % old_commit)
+        return None
+    changed_files = repo.git.diff_tree('-r', '--name-only', '--no-renames', old_commit, new_commit)
+    dirs = set()
+    for path in changed_files.splitlines():
+        parts = path.split('/')
+        # Files like Registry.toml at the top level do not belong to any package.
+        if len(parts) >= 3:
+            dirs.add('%s/%s/' % (parts[0], parts[1]))
+    return sorted(dirs)
+
+
+def update_package_list(config, registry_name, registry_dir, repo, commit, changed_dirs=None, delete=True):
+    packages = {}
+    cache = get_toml_cache(config, registry_name)
+    files = get_registry_files(repo, commit)
+    if changed_dirs is None:
+        # Directories left in the working tree by deleted packages are not in the git tree.
+        dirlist = set(files)
+        dirlist.update(os.path.relpath(d, registry_dir) + '/' for d in glob.glob(os.path.join(registry_dir, '*/*/')))
+        dirlist = sorted(dirlist)
+    else:
+        dirlist = changed_dirs
+    for each_dir in dirlist:
+        package_name = each_dir.split('/')[1]
+        blobs = files.get(each_dir, {})
+        if 'Package.toml' not in blobs:
+            if delete:
+                delete_package(config, package_name, registry_name)
+            else:
+                config.removed_packages.add((registry_name, package_name))
             continue
-        if package_name not in packages:
-            packages[package_name] = {}
-        packages[package_name][registry_name] = package_info
-        packages[package_name][registry_name]['versions'] = get_version_list(each_dir)
-
-
-def update_registry(config, status, name, url):
-    s = status['registries']['registries'][name]
-    if s.get('created_time') is None:
-        s = status['registries']['registries'][name] = {
-            'created_time': _get_current_time(),
-        }
-    logging.info('Updating mirror for registry: %s.' % name)
-    s['status'] = 'synchronizing'
-    save_status(config, status, 'metadata')
+        # The cached entries are shared, so they must not be changed.
+        package_info = dict(cache.load(repo, blobs['Package.toml']))
+        package_info['versions'] = cache.load(repo, blobs['Versions.toml']) if 'Versions.toml' in blobs else {}
+        packages[package_name] = package_info
+    cache.save(set(blob_sha for blobs in files.values() for blob_sha in blobs.values()))
+    return packages
+
+
+def update_registry(config, status, name, url, delete=True):
+    # Registries are updated in parallel, so the status is only changed while holding the lock.
+    with config.status_store.lock:
+        s = status['registries']['registries'][name]
+        if s.get('created_time') is None:
+            s = status['registries']['registries'][name] = {
+                'created_time': _get_current_time(),
+            }
+        logging.info('Updating mirror for registry: %s.' % name)
+        s['status'] = 'synchronizing'
+        save_status(config, status, 'registries')
     registry_dir = os.path.join(config.registries_dir, name)
     mirror_dir = registry_dir + '.git'
-    if not os.path.exists(mirror_dir):
-        logging.info('Cloning from upstream.')
-        clone_from(url, mirror_dir, True)
-    if not os.path.exists(os.path.join(registry_dir, '.git')):
-        logging.info('Cloning to a working tree.')
-        clone_from(mirror_dir, registry_dir, False, False)
-    logging.info('Loading information in %s' % name)
-    mirror_repo = git.Repo(mirror_dir)
-    repo = git.Repo(registry_dir)
-    logging.info('Fetching updates from upstream')
-    update_repo(mirror_repo, True)
-    update_repo(repo, False)
-    update_package_list(config, name, registry_dir)
-    s['status'] = 'updated'
-    save_status(config, status, 'registries', name)
+    # --verify-all scans every package, so that the tarballs it finds corrupt are downloaded again.
+    full_scan = config.full_scan or config.sync_latest or config.verify_all or s.get('commit') is None
+    # Shards of a mirror sharing the same tree update the registries one at a time, see --shard.
+    with open(registry_dir + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(mirror_dir):
+            logging.info('Cloning from upstream.')
+            clone_from(url, mirror_dir, True)
+        if not os.path.exists(os.path.join(registry_dir, '.git')):
+            logging.info('Cloning to a working tree.')
+            clone_from(mirror_dir, registry_dir, False, False, True)
+            full_scan = True
+        logging.info('Loading information in %s' % name)
+        mirror_repo = git.Repo(mirror_dir)
+        repo = git.Repo(registry_dir)
+        logging.info('Fetching updates from upstream')
+        share_objects(repo, mirror_dir)
+        update_repo(mirror_repo, True)
+        update_working_tree(repo, mirror_repo)
+        commit = repo.head.commit.hexsha
+        # The changes are also looked for in a full scan, to download them first.
+        changed_dirs = None if s.get('commit') is None else get_changed_dirs(repo, s['commit'], commit)
+        if changed_dirs is not None:
+            # Packages whose tarballs failed last time are scanned as if they had changed.
+            failed_dirs = ['%s/%s/' % (package_name[0].upper(), package_name) for package_name in s.get('failed', [])]
+            changed_dirs = sorted(set(changed_dirs).union(failed_dirs))
+        if changed_dirs is not None:
+            logging.info('%d packages changed since %s.' % (len(changed_dirs), s['commit']))
+        packages = update_package_list(config, name, registry_dir, mirror_repo, commit,
+                                       None if full_scan else changed_dirs, delete)
+    changed = set() if changed_dirs is None else set(each_dir.split('/')[1] for each_dir in changed_dirs)
+    with config.status_store.lock:
+        s['status'] = 'updated'
+        save_status(config, status, 'registries', name)
     logging.info('Registry %s mirror update completed.' % name)
+    # The commit is saved in the status only after the packages are synchronized.
+    return packages, commit, changed
 
 
-def update_registries(config, status):
+def update_registries(config, status, delete=True):
+    # Without `delete`, the packages removed from the registries are only listed, see --plan.
     s = status['registries']
     if s.get('created_time') is None:
         s = status['registries'] = {
@@ -481,14 +1790,29 @@ def update_registries(config, status):
     for name in config.registries:
         if name not in s['registries']:
             s['registries'][name] = {}
-        try:
-            update_registry(config, status, name, config.registries[name])
-        except Exception as e:
-            logging.error('Failed to update registry: %s' % name)
-            s['registries'][name]['status'] = 'failed'
-            save_status(config, status, 'registries', name)
-            if not config.ignore_invalid:
-                raise e
+    with concurrent.futures.ThreadPoolExecutor(config.registry_workers) as executor:
+        futures = {
+            executor.submit(profiled(config, update_registry), config, status, name, config.registries[name], delete): name
+            for name in config.registries
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                packages, commit, changed = future.result()
+            except Exception as e:
+                logging.error('Failed to update registry: %s' % name)
+                with config.status_store.lock:
+                    s['registries'][name]['status'] = 'failed'
+                    save_status(config, status, 'registries', name)
+                if not config.ignore_invalid:
+                    for each in futures:
+                        each.cancel()
+                    raise e
+                continue
+            for package_name in packages:
+                config.packages.setdefault(package_name, {})[name] = packages[package_name]
+            config.registry_commits[name] = commit
+            config.changed_packages.update(changed)
     with open(os.path.join(config.registries_dir, 'list.txt'), 'w') as fo:
         fo.writelines([name + '\n' for name in s['registries']])
     s['status'] = 'updated'
@@ -496,75 +1820,548 @@ def update_registries(config, status):
     logging.info('Registries mirror update completed.')
 
 
+HASH_BLOCK_SIZE = 1 << 20
+
+
 def get_file_hash(filename):
     sha256_hash = hashlib.sha256()
     with open(filename, 'rb') as f:
-        for byte_block in iter(lambda: f.read(4096), b''):
+        for byte_block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
 
-def check_hash(filename):
+# Keeps the sha256 hash of every file together with its (size, mtime_ns, inode), so that a file
+# is only hashed again after it changes on disk.
+class Manifest(object):
+    def __init__(self, root, filename):
+        self.root = root
+        self.filename = filename
+        self.entries = {}
+        self.hashed_bytes = 0
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            with open(filename) as fi:
+                self.entries = json.load(fi)
+
+    @staticmethod
+    def _stat_key(st):
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get_hash(self, filename):
+        key = os.path.relpath(filename, self.root)
+        st = os.stat(filename)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[:3] == self._stat_key(st):
+            return entry[3]
+        sha256_hash = get_file_hash(filename)
+        self.set_hash(filename, sha256_hash, st)
+        with self.lock:
+            self.hashed_bytes += st.st_size
+        return sha256_hash
+
+    def set_hash(self, filename, sha256_hash, st=None):
+        key = os.path.relpath(filename, self.root)
+        if st is None:
+            st = os.stat(filename)
+        with self.lock:
+            self.entries[key] = self._stat_key(st) + [sha256_hash]
+
+    def get_average_size(self, prefix):
+        # Returns the average size of the files under `prefix`, or `None` if there is none.
+        with self.lock:
+            sizes = [entry[0] for (key, entry) in self.entries.items() if key.startswith(prefix)]
+        return sum(sizes) // len(sizes) if len(sizes) > 0 else None
+
+    def prune(self):
+        with self.lock:
+            for key in [k for k in self.entries if not os.path.isfile(os.path.join(self.root, k))]:
+                del self.entries[key]
+
+    def save(self):
+        with self.lock:
+            save_json(self.filename, self.entries, sort_keys=True)
+
+
+def read_hash_file(filename):
     hashfile = filename + '.sha256'
     if not os.path.exists(hashfile):
-        return False
-    hash_1 = get_file_hash(filename)
+        return None
     with open(hashfile) as fi:
-        hash_2 = fi.read().replace('\n', '')
+        return fi.read().replace('\n', '')
+
+
+def check_hash(filename, manifest=None):
+    hash_2 = read_hash_file(filename)
+    if hash_2 is None:
+        return False
+    hash_1 = get_file_hash(filename) if manifest is None else manifest.get_hash(filename)
     return hash_1 == hash_2
 
 
+def _hash_task(filename):
+    return filename, os.stat(filename), get_file_hash(filename)
+
+
+def _list_tarballs(path, depth):
+    filelist = []
+    for entry in os.scandir(path):
+        if depth > 0 and entry.is_dir(follow_symlinks=False):
+            filelist.extend(_list_tarballs(entry.path, depth - 1))
+        elif depth == 0 and entry.name.endswith('.tar.gz') and entry.is_file(follow_symlinks=False):
+            filelist.append((entry.path, entry.inode()))
+    return filelist
+
+
+def verify_all(config, manifest):
+    logging.info('Verifying all the package tarballs.')
+    filelist = [
+        (filename, inode) for (filename, inode) in _list_tarballs(config.packages_dir, 2)
+        if in_shard(config, os.path.basename(os.path.dirname(os.path.dirname(filename))))
+    ]
+    if os.path.isdir(config.objects_dir):
+        filelist.extend(_list_tarballs(config.objects_dir, 1))
+    # Hardlinked copies in different registries are only hashed once. Those that do not match their
+    # .sha256 file fail `check_hash`, so the scan of the packages downloads them again.
+    inodes = {}
+    for (filename, inode) in filelist:
+        inodes.setdefault(inode, []).append(filename)
+    corrupt = 0
+    with multiprocessing.pool.Pool(config.max_processes) as pool:
+        tasks = [filenames[0] for filenames in inodes.values()]
+        for (filename, st, sha256_hash) in pool.imap_unordered(_hash_task, tasks, 16):
+            config.metrics.inc('bytes_hashed', st.st_size, phase='packages')
+            if read_hash_file(filename) not in (None, sha256_hash):
+                logging.error('%s does not match its .sha256 file, it will be downloaded again.' % filename)
+                corrupt += 1
+            for each_file in inodes[st.st_ino]:
+                manifest.set_hash(each_file, sha256_hash, st)
+    manifest.prune()
+    logging.info('Verified %d package tarballs, %d corrupt.' % (len(filelist), corrupt))
+
+
+def link_file(src, dst):
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmpfile = dst + '.tmp'
+    if os.path.lexists(tmpfile):
+        os.unlink(tmpfile)
+    try:
+        os.link(src, tmpfile)
+    except OSError:
+        # e.g. the store is on another file system.
+        os.symlink(os.path.relpath(src, os.path.dirname(dst)), tmpfile)
+    os.replace(tmpfile, dst)
+
+
+# Stores each tarball once, named by its git-tree-sha1, so that a package registered in several
+# registries is only downloaded and stored once. The directories in packages/ link into it.
+class ObjectStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.waiting = {}
+
+    def get_path(self, sha):
+        return os.path.join(self.path, sha[:2], sha + '.tar.gz')
+
+    def add(self, sha, filepath):
+        # Adopts a verified tarball which was downloaded before the store existed, or replaces it
+        # with a link if the store already has the same file.
+        object_path = self.get_path(sha)
+        if not os.path.exists(object_path):
+            makedir(os.path.dirname(object_path))
+            link_file(filepath, object_path)
+            link_file(filepath + '.sha256', object_path + '.sha256')
+        elif not os.path.samefile(object_path, filepath) and read_hash_file(object_path) == read_hash_file(filepath):
+            self.link(sha, filepath)
+
+    def link(self, sha, filepath):
+        object_path = self.get_path(sha)
+        link_file(object_path, filepath)
+        link_file(object_path + '.sha256', filepath + '.sha256')
+
+    def request(self, sha, callback):
+        # Returns True if the caller should download the object. Otherwise the callback will be
+        # called once the pending download of the same object finishes.
+        with self.lock:
+            if sha in self.waiting:
+                self.waiting[sha].append(callback)
+                return False
+            self.waiting[sha] = [callback]
+            makedir(os.path.dirname(self.get_path(sha)))
+            return True
+
+    def finish(self, sha):
+        with self.lock:
+            return self.waiting.pop(sha)
+
+
+def get_version_key(version):
+    # Sorts version numbers like 1.2.3, with the pre-releases before their release.
+    m = re.match(r'^(\d+)\.(\d+)\.(\d+)(?:-([^+]*))?', version)
+    if m is None:
+        return (-1, -1, -1, 0, version)
+    pre = m.group(4)
+    return (int(m.group(1)), int(m.group(2)), int(m.group(3)), 0 if pre else 1, pre or '')
+
+
+def in_shard(config, package_name):
+    # Packages are split by a hash of their names that is the same on every machine, so all the
+    # tarballs of a package are always downloaded by the same shard.
+    if config.shard is None:
+        return True
+    (i, n) = config.shard
+    return int(hashlib.sha1(package_name.encode()).hexdigest(), 16) % n == i - 1
+
+
+def get_missing_versions(config, package_name, registry, link_existing=True):
+    # Returns (rank, version, sha) of the versions of a package whose tarballs are neither in its
+    # directory nor in the store, with the newest versions ranked first. With `link_existing`, the
+    # tarballs that are found are added to the store or linked into the directory.
+    version_list = config.packages[package_name][registry]['versions']
+    current_dir = os.path.join(config.packages_dir, package_name, registry)
+    objects = config.objects
+    missing = []
+    versions = sorted(version_list, key=get_version_key, reverse=True)
+    for (rank, version) in enumerate(versions):
+        sha = version_list[version]['git-tree-sha1']
+        filename = '%s-%s.tar.gz' % (package_name, sha)
+        filepath = os.path.join(current_dir, filename)
+        if os.path.exists(filepath) and check_hash(filepath, config.manifest):
+            if link_existing:
+                objects.add(sha, filepath)
+                config.metrics.inc('files', phase='packages', result='skipped')
+            continue
+        object_path = objects.get_path(sha)
+        if os.path.exists(object_path) and check_hash(object_path, config.manifest):
+            if link_existing:
+                link_package_file(config, current_dir, package_name, version, sha,
+                                  config.manifest.get_hash(object_path))
+                config.metrics.inc('files', phase='packages', result='skipped')
+            continue
+        missing.append((rank, version, sha))
+    return missing
+
+
+def get_package_files(config, package_name, registry, fetcher, link_existing=True):
+    # Returns the files to download for a package, as listed in a plan: the missing versions with
+    # their rank (see `get_missing_versions`), and the latest tarball with --sync-latest-packages.
+    files = [
+        {
+            'version': version,
+            'sha': sha,
+            'rank': rank,
+            'url': fetcher.get_tarball_url(sha),
+            'filename': os.path.relpath(config.objects.get_path(sha), config.root)
+        }
+        for (rank, version, sha) in get_missing_versions(config, package_name, registry, link_existing)
+    ]
+    if config.sync_latest:
+        # The latest tarball changes over time, so it is not kept in the store.
+        files.append({
+            'version': None,
+            'sha': None,
+            'rank': 0,
+            'url': fetcher.get_tarball_url(None),
+            'filename': os.path.join('packages', package_name, registry, '%s-latest.tar.gz' % package_name)
+        })
+    return files
+
+
 def update_package(config, status, package_name, registry):
     logging.debug('Updating mirror for package: %s (%s)' % (package_name, registry))
     package = config.packages[package_name][registry]
-    version_list = package['versions']
     current_dir = os.path.join(config.packages_dir, package_name, registry)
     makedir(current_dir)
     linkdir = os.path.join(
         config.registries_dir, registry,
         package_name[0].upper(), package_name
     )
-    makelink(current_dir, os.path.join(linkdir, 'releases'))
-    makelink(linkdir, os.path.join(current_dir, package_name))
-    urllist = []
-    m = re.match(r'^https://github.com/(.*?)/(.*?)\.git$', package['repo'])
-    if m is None:
-        # TODO: Add support for non-github registries.
-        logging.warning('Packages not on github are currently not supported.')
-        return
-    url_base = 'https://api.github.com/repos/%s/%s/tarball/' % m.groups()
-    verlist = []
-    for version in version_list:
-        sha = version_list[version]['git-tree-sha1']
-        filename = '%s-%s.tar.gz' % (package_name, sha)
-        url = url_base + sha
-        filepath = os.path.join(current_dir, filename)
-        if os.path.exists(filepath) and check_hash(filepath):
+    # Without the registry the links are left to a run that synchronizes it, or to update_symlinks.py.
+    if has_registry(config, registry):
+        set_link(current_dir, os.path.join(linkdir, 'releases'))
+        set_link(linkdir, os.path.join(current_dir, package_name))
+    fetcher = get_fetcher(config, package['repo'])
+    # A plan lists the files to download itself, see `execute_plan`.
+    files = package.get('files')
+    if files is None:
+        files = get_package_files(config, package_name, registry, fetcher)
+    objects = config.objects
+    archives = []
+    # The newest versions of every package are downloaded first, and among them those of the
+    # packages changed in the registries.
+    changed = 0 if package_name in config.changed_packages else 1
+    for f in files:
+        filepath = os.path.join(config.root, f['filename'])
+        if f['sha'] is None:
+            callback = functools.partial(finish_latest_file, config)
+            if f['url'] is None:
+                archives.insert(0, ('HEAD', filepath, callback))
+            else:
+                config.downloader.submit(f['url'], filepath, callback, host=fetcher.host, priority=(0, changed))
             continue
-        urllist.append((filename, url))
-        verlist.append(version)
-    if config.sync_latest:
-        urllist.append(('%s-latest.tar.gz' % package_name, url_base + 'master'))
-    download_all(config, current_dir, urllist)
-    for version, (filename, url) in itertools.zip_longest(verlist, urllist):
-        filepath = os.path.join(current_dir, filename)
-        if not os.path.exists(filepath):
+        sha = f['sha']
+        if os.path.exists(filepath) and check_hash(filepath, config.manifest):
+            # Downloaded since the plan was made, e.g. by an interrupted --execute.
+            link_package_file(config, current_dir, package_name, f['version'], sha,
+                              config.manifest.get_hash(filepath))
+            continue
+        link_version = functools.partial(finish_package_file, config, registry, package_name, f['version'], sha)
+        if not objects.request(sha, link_version):
+            continue
+        callback = functools.partial(finish_object, config, sha)
+        if f['url'] is None:
+            archives.append((sha, filepath, callback))
+        else:
+            config.downloader.submit(f['url'], filepath, callback, host=fetcher.host, priority=(f['rank'], changed))
+    if len(archives) > 0:
+        mirror_dir = get_package_mirror_dir(config, package['repo'])
+        items = [(treeish, filepath) for (treeish, filepath, callback) in archives]
+        callbacks = [callback for (treeish, filepath, callback) in archives]
+        config.downloader.submit_task(
+            archive_package, (package['repo'], mirror_dir, package_name, items),
+            functools.partial(finish_archives, callbacks), fetcher.host, (0, changed)
+        )
+
+
+# Fetchers tell where to get the tarball of a tree from the repository of a package. They are
+# chosen by the host of the repository, see `get_fetcher`.
+class GitFetcher(object):
+    # Works for any git host, see `archive_package`.
+    def __init__(self, url):
+        self.url = url
+        self.host = get_host(url)
+
+    def get_tarball_url(self, treeish):
+        # `None` for the latest tarball. Returns `None` if the tarball should be made by git archive.
+        return None
+
+
+class GitHubFetcher(GitFetcher):
+    def __init__(self, url):
+        super().__init__(url)
+        m = re.match(r'^https://github.com/(.*?)/(.*?)(?:\.git)?/?$', url)
+        if m is None:
+            raise ValueError('Not a GitHub repository: %s' % url)
+        self.url_base = '%s/repos/%s/%s/tarball/' % ((Config.GITHUB_API,) + m.groups())
+
+    def get_tarball_url(self, treeish):
+        return self.url_base + ('master' if treeish is None else treeish)
+
+
+class GitLabFetcher(GitFetcher):
+    def __init__(self, url):
+        super().__init__(url)
+        m = re.match(r'^https://([^/]+)/(.*?)(?:\.git)?/?$', url)
+        if m is None:
+            raise ValueError('Not a GitLab repository: %s' % url)
+        project = urllib.parse.quote(m.group(2), safe='')
+        self.url_base = 'https://%s/api/v4/projects/%s/repository/archive.tar.gz' % (m.group(1), project)
+
+    def get_tarball_url(self, treeish):
+        # The archive API of GitLab looks up `sha` as a commit or a ref, not the trees named in the
+        # registries, so only the latest tarball (of the default branch) is downloaded from it.
+        return self.url_base if treeish is None else None
+
+
+FETCHERS = {
+    'github': GitHubFetcher,
+    'gitlab': GitLabFetcher,
+    'git': GitFetcher
+}
+
+
+def get_fetcher(config, url):
+    if config.fetch_mode == 'git':
+        return GitFetcher(url)
+    host = get_host(url)
+    backend = config.host_backends.get(host, Config.HOST_BACKENDS.get(host, 'git'))
+    try:
+        return FETCHERS[backend](url)
+    except ValueError as e:
+        logging.warning('%s, falling back to git.' % e)
+        return GitFetcher(url)
+
+
+def get_package_mirror_dir(config, url):
+    # e.g. https://github.com/JuliaLang/Example.jl.git -> github.com/JuliaLang/Example.jl.git
+    m = re.match(r'^(?:[a-z+]+://)?(?:[^@/]*@)?([^/:]*)[:/]+(.*?)(?:\.git)?/*$', url)
+    parts = [] if m is None else [m.group(1)] + m.group(2).split('/')
+    parts = [part for part in parts if part not in ('', '.', '..')]
+    if len(parts) == 0:
+        parts = [hashlib.sha1(url.encode()).hexdigest()]
+    return os.path.join(config.repos_dir, *parts) + '.git'
+
+
+def fetch_package_repo(url, mirror_dir, attempts=3):
+    if not os.path.exists(mirror_dir):
+        logging.info('Cloning %s' % url)
+        makedir(os.path.dirname(mirror_dir))
+        tempdir = tempfile.mkdtemp()
+        git.Repo.clone_from(url, tempdir, bare=True)
+        shutil.move(tempdir, mirror_dir)
+    # Only the changes since the last fetch are transferred.
+    repo = git.Repo(mirror_dir)
+    for i in range(attempts):
+        try:
+            repo.git.fetch('--prune', 'origin', '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+            break
+        except git.GitCommandError:
+            if i == attempts - 1:
+                raise
+    return repo
+
+
+def archive_tree(url, mirror_dir, package_name, treeish, filename):
+    logging.info('Archiving %s of %s to %s' % (treeish, url, filename))
+    f = tempfile.NamedTemporaryFile(delete=False)
+    f.close()
+    prefix = '%s-%s/' % (package_name, treeish)
+    proc = subprocess.Popen(
+        ['git', 'archive', '--format=tar.gz', '--prefix=' + prefix, treeish],
+        cwd=mirror_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    fo = HashingWriter(f.name, 'wb')
+    try:
+        shutil.copyfileobj(proc.stdout, fo)
+    finally:
+        fo.close()
+        err = proc.stderr.read().decode(errors='replace')
+        proc.wait()
+    if proc.returncode != 0:
+        os.unlink(f.name)
+        logging.error('Failed to archive %s of %s' % (treeish, url))
+        logging.error(err)
+        return None
+    shutil.move(f.name, filename)
+    os.chmod(filename, 0o644)
+    return {'filename': filename, 'url': url, 'modified': True, 'sha256': fo.hexdigest()}
+
+
+def archive_package(config, url, mirror_dir, package_name, items):
+    # Packages in several registries may share a mirror, so only one worker may use it at a time.
+    makedir(os.path.dirname(mirror_dir))
+    with open(mirror_dir + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            fetch_package_repo(url, mirror_dir, config.host_retries.get(get_host(url), 2) + 1)
+        except git.GitCommandError as e:
+            logging.error('Failed to fetch %s' % url)
+            logging.error(e)
+            return [None] * len(items)
+        return [archive_tree(url, mirror_dir, package_name, treeish, filename) for (treeish, filename) in items]
+
+
+def finish_archives(callbacks, results):
+    if results is None:
+        results = [None] * len(callbacks)
+    for (callback, result) in zip(callbacks, results):
+        callback(result)
+
+
+def write_hash_file(config, filepath, sha256_hash):
+    config.manifest.set_hash(filepath, sha256_hash)
+    with open(filepath + '.sha256', 'w') as fo:
+        fo.write(sha256_hash)
+        fo.write('\n')
+
+
+def finish_latest_file(config, result):
+    if result is not None:
+        write_hash_file(config, result['filename'], result['sha256'])
+
+
+def finish_object(config, sha, result):
+    callbacks = config.objects.finish(sha)
+    if result is None:
+        for callback in callbacks:
+            callback(None)
+        return
+    write_hash_file(config, result['filename'], result['sha256'])
+    for callback in callbacks:
+        callback(result['sha256'])
+
+
+def finish_package_file(config, registry, package_name, version, sha, sha256_hash):
+    # `sha256_hash` is `None` if the tarball could not be downloaded.
+    if sha256_hash is None:
+        config.failed_packages.add((registry, package_name))
+        return
+    current_dir = os.path.join(config.packages_dir, package_name, registry)
+    link_package_file(config, current_dir, package_name, version, sha, sha256_hash)
+
+
+def link_package_file(config, current_dir, package_name, version, sha, sha256_hash):
+    filepath = os.path.join(current_dir, '%s-%s.tar.gz' % (package_name, sha))
+    sha256_file = filepath + '.sha256'
+    config.objects.link(sha, filepath)
+    config.manifest.set_hash(filepath, sha256_hash)
+    version_filepath = os.path.join(current_dir, '%s-%s.tar.gz' % (package_name, version))
+    set_link(filepath, version_filepath)
+    set_link(sha256_file, version_filepath + '.sha256')
+
+
+def get_index_entries(manifest, package_name, registry_name, versions):
+    # Returns {version: info} of the versions whose tarballs are in the manifest, with the hash that
+    # their .sha256 file tells. Those that do not match it are left out until they are downloaded again.
+    entries = {}
+    for (version, info) in versions.items():
+        sha = info['git-tree-sha1']
+        path = 'packages/%s/%s/%s-%s.tar.gz' % (package_name, registry_name, package_name, sha)
+        entry = manifest.entries.get(path)
+        if entry is None:
             continue
-        sha256_file = filepath + '.sha256'
-        sha256_hash = get_file_hash(filepath)
-        with open(sha256_file, 'w') as fo:
-            fo.write(sha256_hash)
-            fo.write('\n')
-        if version is None:
+        if read_hash_file(os.path.join(manifest.root, path)) != entry[3]:
+            logging.warning('%s does not match its .sha256 file and is not listed.' % path)
             continue
-        version_filepath = os.path.join(current_dir, '%s-%s.tar.gz' % (package_name, version))
-        version_sha256 = version_filepath + '.sha256'
-        if os.path.exists(version_filepath):
-            os.unlink(version_filepath)
-        if os.path.exists(version_sha256):
-            os.unlink(version_sha256)
-        makelink(filepath, version_filepath)
-        makelink(sha256_file, version_sha256)
+        entries[version] = {'git-tree-sha1': sha, 'size': entry[0], 'sha256': entry[3], 'path': path}
+    return entries
+
+
+def update_index(config, registry_name, manifest):
+    # Writes index/<registry>.json.gz with the tarballs of all the packages in the registry, and
+    # index/<registry>/<package>.json.gz with those of each package. Only the files of the packages
+    # that changed since the last index are written again.
+    registry_dir = os.path.join(config.registries_dir, registry_name)
+    registry_versions = read_registry_versions(registry_dir, get_toml_cache(config, registry_name))
+    packages = {}
+    for (package_name, versions) in registry_versions.items():
+        entries = get_index_entries(manifest, package_name, registry_name, versions)
+        if len(entries) > 0:
+            packages[package_name] = entries
+    index_file = os.path.join(config.index_dir, registry_name + '.json.gz')
+    old_index = load_json_gz(index_file) or {}
+    old_packages = old_index.get('packages', {})
+    package_dir = os.path.join(config.index_dir, registry_name)
+    makedir(package_dir)
+    existing = set(entry.name for entry in os.scandir(package_dir))
+    written = 0
+    for (package_name, entries) in packages.items():
+        filename = package_name + '.json.gz'
+        if filename not in existing or old_packages.get(package_name) != entries:
+            save_json_gz(os.path.join(package_dir, filename), entries)
+            written += 1
+    for filename in existing:
+        if filename[:-len('.json.gz')] not in packages:
+            os.unlink(os.path.join(package_dir, filename))
+    commit = git.Repo(registry_dir).head.commit.hexsha
+    if old_index.get('commit') != commit or old_packages != packages:
+        save_json_gz(index_file, {
+            'registry': registry_name,
+            'commit': commit,
+            'updated_time': _get_current_time(),
+            'packages': packages
+        })
+    logging.info('Index of %s: %d packages, %d written.' % (registry_name, len(packages), written))
+
+
+def update_indexes(config, manifest):
+    makedir(config.index_dir)
+    for registry_name in config.registries:
+        if has_registry(config, registry_name):
+            update_index(config, registry_name, manifest)
 
 
 def update_packages(config, status):
@@ -577,9 +2374,34 @@ def update_packages(config, status):
     logging.info('Updating mirror for packages.')
     s['status'] = 'synchronizing'
     save_status(config, status, 'packages')
-    for package_name in config.packages:
-        for registry in config.packages[package_name]:
-            update_package(config, status, package_name, registry)
+    config.manifest = Manifest(config.root, config.manifest_file)
+    config.objects = ObjectStore(config.objects_dir)
+    try:
+        if config.verify_all:
+            verify_all(config, config.manifest)
+        for package_name in config.packages:
+            if not in_shard(config, package_name):
+                continue
+            for registry in config.packages[package_name]:
+                update_package(config, status, package_name, registry)
+        config.downloader.wait()
+    finally:
+        config.manifest.save()
+        config.metrics.inc('bytes_hashed', config.manifest.hashed_bytes, phase='packages')
+    # A shard only knows its own tarballs, the index is written by --merge-shards.
+    if config.shard is None:
+        update_indexes(config, config.manifest)
+    if len(config.failed_packages) > 0:
+        logging.warning('%d packages have tarballs that failed, they will be scanned again by the next run.' % (
+            len(config.failed_packages)))
+    with config.status_store.lock:
+        for (name, commit) in config.registry_commits.items():
+            s_registry = status['registries']['registries'][name]
+            s_registry['commit'] = commit
+            s_registry['failed'] = sorted(
+                package_name for (registry, package_name) in config.failed_packages if registry == name
+            )
+        config.status_store.save(status, ['registries'])
     s['status'] = 'updated'
     save_status(config, status, 'packages')
     logging.info('Packages mirror update completed.')
@@ -607,30 +2429,452 @@ def update_client(config, status):
     logging.info('Client mirror update completed.')
 
 
+def archive_registry(mirror_dir, tree, filename):
+    # The tarball of a tree has no prefix nor commit header, so its content hashes to `tree`.
+    logging.info('Archiving registry tree %s to %s' % (tree, filename))
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'wb') as fo:
+        subprocess.run(['git', 'archive', '--format=tar.gz', tree], cwd=mirror_dir, stdout=fo, check=True)
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, filename)
+
+
+def _reroot_task(args):
+    # Package tarballs keep the top level directory of the archives from GitHub, but the Pkg server
+    # protocol serves the files of the package tree at the top level.
+    # Returns the error if the tarball cannot be read.
+    (src, dst) = args
+    tmpfile = dst + '.tmp'
+    try:
+        with tarfile.open(src, 'r:gz') as fi, tarfile.open(tmpfile, 'w:gz') as fo:
+            for member in fi:
+                name = member.name.split('/', 1)[1] if '/' in member.name else ''
+                if name.strip('/') == '':
+                    continue
+                member.name = name
+                if member.islnk():
+                    member.linkname = member.linkname.split('/', 1)[1]
+                fo.addfile(member, fi.extractfile(member) if member.isfile() else None)
+    except Exception as e:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        return src, dst, str(e)
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, dst)
+    return src, dst, None
+
+
+def _read_server_registries(filename):
+    # Returns {uuid: tree} listed in a `registries` file.
+    registries = {}
+    if os.path.isfile(filename):
+        with open(filename) as fi:
+            for line in fi:
+                parts = line.strip().split('/')
+                if len(parts) == 4 and parts[1] == 'registry':
+                    registries[parts[2]] = parts[3]
+    return registries
+
+
+def update_server(config, status):
+    # Writes the static files of the Pkg server protocol to server/:
+    # - registries, which lists /registry/<uuid>/<tree> of each registry,
+    # - registry/<uuid>/<tree>, the tarball of the tree of the registry at its synchronized commit,
+    # - package/<uuid>/<tree>, the tarball of each version of each package.
+    # Files named by tree hashes never change, so only the new ones are written. The trees whose
+    # tarball cannot be converted are listed in the status with the hash of that tarball, and are
+    # not tried again until it is downloaded again.
+    s = status.get('server', {})
+    if s.get('created_time') is None:
+        s = status['server'] = {
+            'created_time': _get_current_time()
+        }
+    logging.info('Updating files for Pkg servers.')
+    s['status'] = 'synchronizing'
+    save_status(config, status, 'server')
+    makedir(config.server_dir)
+    registries_file = os.path.join(config.server_dir, 'registries')
+    old_registries = _read_server_registries(registries_file)
+    manifest = Manifest(config.root, config.manifest_file)
+    registries = {}
+    packages = {}
+    for registry_name in sorted(config.registries):
+        registry_dir = os.path.join(config.registries_dir, registry_name)
+        if not has_registry(config, registry_name):
+            continue
+        uuid = toml.load(os.path.join(registry_dir, 'Registry.toml')).get('uuid')
+        if uuid is None:
+            logging.warning('Registry %s has no uuid and cannot be served.' % registry_name)
+            continue
+        tree = git.Repo(registry_dir).head.commit.tree.hexsha
+        registry_path = os.path.join(config.server_dir, 'registry', uuid)
+        makedir(registry_path)
+        if not os.path.exists(os.path.join(registry_path, tree)):
+            archive_registry(registry_dir + '.git', tree, os.path.join(registry_path, tree))
+        # The tree listed before is kept for the clients that have just read it.
+        for entry in os.scandir(registry_path):
+            if entry.name not in (tree, old_registries.get(uuid)):
+                os.unlink(entry.path)
+        registries[uuid] = tree
+        registry_packages = read_registry_packages(registry_dir, get_toml_cache(config, registry_name))
+        for (package_name, package_info) in registry_packages.items():
+            entries = get_index_entries(manifest, package_name, registry_name, package_info['versions'])
+            for info in entries.values():
+                packages[(package_info['uuid'], info['git-tree-sha1'])] = os.path.join(config.root, info['path'])
+    # The same tree of a package may be registered in several registries.
+    created = {}
+    tasks = []
+    old_failed = s.get('failed', {})
+    failed = {}
+    package_dir = os.path.join(config.server_dir, 'package')
+    for ((uuid, sha), src) in sorted(packages.items()):
+        dst = os.path.join(package_dir, uuid, sha)
+        if os.path.exists(dst):
+            created.setdefault(sha, dst)
+            continue
+        key = '%s/%s' % (uuid, sha)
+        if key in old_failed and old_failed[key] == manifest.get_hash(src):
+            failed[key] = old_failed[key]
+            continue
+        makedir(os.path.dirname(dst))
+        tasks.append((key, sha, src, dst))
+    waiting = []
+    for (key, sha, src, dst) in tasks:
+        if sha not in created:
+            created[sha] = dst
+            waiting.append((src, dst))
+    with multiprocessing.pool.Pool(config.max_processes) as pool:
+        for (src, dst, err) in pool.imap_unordered(_reroot_task, waiting, 4):
+            if err is not None:
+                logging.error('Failed to convert %s: %s' % (src, err))
+    written = 0
+    for (key, sha, src, dst) in tasks:
+        if not os.path.exists(dst) and os.path.exists(created[sha]):
+            link_file(created[sha], dst)
+        if os.path.exists(dst):
+            written += 1
+        else:
+            failed[key] = manifest.get_hash(src)
+    config.metrics.inc('files', len(failed), phase='server', result='failed')
+    if len(failed) > 0:
+        logging.warning('%d package trees could not be converted, they are tried again once their tarballs change.' % (
+            len(failed)))
+    removed = 0
+    if os.path.isdir(package_dir):
+        for each_dir in os.scandir(package_dir):
+            for entry in os.scandir(each_dir.path):
+                if (each_dir.name, entry.name) not in packages:
+                    os.unlink(entry.path)
+                    removed += 1
+            if len(os.listdir(each_dir.path)) == 0:
+                os.rmdir(each_dir.path)
+    # Written last, so that everything it lists is already there.
+    with open(registries_file + '.tmp', 'w') as fo:
+        fo.writelines('/registry/%s/%s\n' % (uuid, tree) for (uuid, tree) in sorted(registries.items()))
+    os.replace(registries_file + '.tmp', registries_file)
+    s['failed'] = failed
+    s['status'] = 'updated'
+    save_status(config, status, 'server')
+    logging.info('Files for Pkg servers updated: %d registries, %d package trees (%d new, %d removed).' % (
+        len(registries), len(packages), written, removed))
+
+
+# A plan lists what a synchronization would download, without downloading it. The registries are
+# still updated to know the packages. `execute_plan` later downloads what is listed, possibly on
+# another machine or with --shard.
+def get_remote_file_info(url, filename, validators):
+    # Asks for the size of a file with a HEAD request, and whether it is different from the local one.
+    headers = {}
+    if validators is not None and os.path.isfile(filename):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    request = urllib.request.Request(url, headers=headers, method='HEAD')
+    try:
+        with urllib.request.urlopen(request) as response:
+            length = response.headers.get('Content-Length')
+            return {'modified': True, 'size': None if length is None else int(length)}
+    except urllib.request.HTTPError as e:
+        if e.code == 304:
+            return {'modified': False, 'size': 0}
+        return {'modified': True, 'size': None, 'error': str(e)}
+    except (urllib.error.URLError, http.client.HTTPException, ConnectionError) as e:
+        return {'modified': True, 'size': None, 'error': str(e)}
+
+
+def plan_releases(config, status, meta):
+    s = status['releases']
+    releases = {}
+    with concurrent.futures.ThreadPoolExecutor(config.max_processes) as executor:
+        for version in get_stale_releases(config, s, meta):
+            mv = meta['versions'][version]
+            validators = s.get(version, {}).get('validators', {})
+            version_dir = os.path.join(config.releases_dir, version)
+            futures = [
+                executor.submit(get_remote_file_info, url, os.path.join(version_dir, filename),
+                                validators.get(filename))
+                for (filename, url) in mv['urllist']
+            ]
+            files = []
+            for ((filename, url), future) in zip(mv['urllist'], futures):
+                info = future.result()
+                if info['modified']:
+                    files.append(dict(info, filename=os.path.join('releases', version, filename), url=url))
+            releases[version] = {'subversion': mv['subversion'], 'files': files}
+    return releases
+
+
+def plan_packages(config):
+    # Tarballs are only known by their git-tree-sha1, so their size is estimated from the store.
+    size = config.manifest.get_average_size('objects' + os.sep)
+    packages = []
+    for package_name in sorted(config.packages):
+        if not in_shard(config, package_name):
+            continue
+        for registry in sorted(config.packages[package_name]):
+            package = config.packages[package_name][registry]
+            fetcher = get_fetcher(config, package['repo'])
+            files = [dict(f, size=size) for f in get_package_files(config, package_name, registry, fetcher, False)]
+            if len(files) > 0:
+                packages.append({'name': package_name, 'registry': registry, 'repo': package['repo'], 'files': files})
+    return packages
+
+
+def make_plan(config, status):
+    logging.info('Planning the synchronization.')
+    plan = {
+        'created_time': _get_current_time(),
+        'mirror_name': config.mirror_name,
+        'sync_latest': config.sync_latest
+    }
+    files = []
+    if config.mirror_releases:
+        (fd, tmpfile) = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            meta = fetch_releaseinfo(config, status, tmpfile)
+        finally:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+        plan['releaseinfo'] = meta
+        plan['releases'] = plan_releases(config, status, meta)
+        files.extend(f for each in plan['releases'].values() for f in each['files'])
+    if config.mirror_packages and len(config.registries) > 0:
+        # Packages removed from the registries are deleted by --execute, not while planning.
+        try_update('registries', functools.partial(update_registries, delete=False), config, status)
+        config.manifest = Manifest(config.root, config.manifest_file)
+        config.objects = ObjectStore(config.objects_dir)
+        try:
+            plan['packages'] = plan_packages(config)
+        finally:
+            config.manifest.save()
+        plan['removed'] = [
+            {'name': package_name, 'registry': registry} for (registry, package_name) in sorted(config.removed_packages)
+        ]
+        # The same tarball may be needed by several registries.
+        files.extend({f['filename']: f for each in plan['packages'] for f in each['files']}.values())
+    plan['summary'] = {
+        'files': len(files),
+        'known_bytes': sum(f['size'] for f in files if f['size'] is not None),
+        'unknown_sizes': len([f for f in files if f['size'] is None])
+    }
+    save_json(config.plan_file, plan, indent=2, sort_keys=True)
+    logging.info('Plan of %d files (%d bytes known) saved to %s' % (
+        len(files), plan['summary']['known_bytes'], config.plan_file))
+
+
+def execute_plan(config, status):
+    with open(config.plan_file) as fi:
+        plan = json.load(fi)
+    logging.info('Executing the plan made at %s.' % plan['created_time'])
+    # The files are downloaded from the URLs to the paths of the plan, whatever this root already has.
+    config.packages = {}
+    for package in plan.get('packages', []):
+        config.packages.setdefault(package['name'], {})[package['registry']] = {
+            'repo': package['repo'],
+            'files': package['files']
+        }
+    for registry in sorted(set(package['registry'] for package in plan.get('packages', []))):
+        if not has_registry(config, registry):
+            logging.warning('Registry %s is not in %s, its links and index are not written.' % (
+                registry, config.root))
+    with DOWNLOADERS[config.engine](config) as downloader:
+        config.downloader = downloader
+        if config.mirror_releases and 'releaseinfo' in plan:
+            update = functools.partial(update_releases, meta=plan['releaseinfo'], versions=sorted(plan['releases']))
+            try_update('releases', update, config, status)
+        if config.mirror_packages:
+            for removed in plan.get('removed', []):
+                delete_package(config, removed['name'], removed['registry'])
+        if config.mirror_packages and len(config.packages) > 0:
+            try_update('packages', update_packages, config, status)
+    config.downloader = None
+
+
+def _merge_section(sections):
+    # Takes the section of the shard that updated it last.
+    sections = [each for each in sections if each is not None]
+    updated = [each for each in sections if each.get('status') == 'updated'] or sections
+    return max(updated, key=lambda each: each.get('last_updated') or '') if updated else None
+
+
+def merge_status(status, shard_statuses):
+    # Every shard downloads its part of the packages.
+    sections = [each['packages'] for each in shard_statuses]
+    failed = [each['status'] for each in sections if each.get('status') != 'updated']
+    status['packages'] = {
+        'created_time': min(each.get('created_time') or '' for each in sections),
+        'last_updated': max(each.get('last_updated') or '' for each in sections),
+        'status': failed[0] if failed else 'updated'
+    }
+    registries = _merge_section([each.get('registries') for each in shard_statuses])
+    if registries is None:
+        return
+    registries = dict(registries, registries={})
+    names = set(name for each in shard_statuses for name in each.get('registries', {}).get('registries', {}))
+    for name in names:
+        sections = [each.get('registries', {}).get('registries', {}).get(name) for each in shard_statuses]
+        merged = dict(_merge_section(sections))
+        # The shards may have synchronized different commits of the registry. Without one that all
+        # of them have finished, the next run scans the whole registry.
+        commits = set(None if each is None else each.get('commit') for each in sections)
+        merged.pop('commit', None)
+        if len(commits) == 1 and None not in commits:
+            merged['commit'] = commits.pop()
+        # Each shard only knows the failed packages of its own part.
+        merged['failed'] = sorted(set(
+            package_name for each in sections if each is not None for package_name in each.get('failed', [])
+        ))
+        registries['registries'][name] = merged
+    status['registries'] = registries
+
+
+def merge_shards(config, status):
+    manifests = {}
+    for filename in glob.glob(os.path.join(config.root, 'manifest.shard-*-of-*.json')):
+        m = re.match(r'^manifest\.shard-(\d+)-of-(\d+)\.json$', os.path.basename(filename))
+        if m is not None:
+            manifests[(int(m.group(1)), int(m.group(2)))] = filename
+    counts = set(n for (i, n) in manifests)
+    if len(counts) != 1:
+        raise Exception('Expected the shards of one split but found: %s' % sorted(manifests))
+    n = counts.pop()
+    missing = [i for i in range(1, n + 1) if (i, n) not in manifests]
+    if len(missing) > 0:
+        raise Exception('Shards %s of %d are missing' % (missing, n))
+    logging.info('Merging %d shards.' % n)
+    manifest = Manifest(config.root, config.manifest_file)
+    for i in range(1, n + 1):
+        with open(manifests[(i, n)]) as fi:
+            manifest.entries.update(json.load(fi))
+    # Files copied from another machine are hashed again, since their inodes have changed.
+    filelist = _list_tarballs(config.packages_dir, 2)
+    invalid = [filename for (filename, inode) in filelist if not check_hash(filename, manifest)]
+    for filename in invalid:
+        logging.error('Invalid tarball: %s' % filename)
+    manifest.prune()
+    manifest.save()
+    update_indexes(config, manifest)
+    shard_statuses = []
+    for i in range(1, n + 1):
+        store = StatusStore(os.path.join(config.root, 'status.shard-%d-of-%d.db' % (i, n)))
+        try:
+            shard_status = store.load()
+        finally:
+            store.close()
+        if shard_status is None:
+            raise Exception('Status of shard %d of %d is missing' % (i, n))
+        shard_statuses.append(shard_status)
+    merge_status(status, shard_statuses)
+    if len(invalid) > 0:
+        status['packages']['status'] = 'failed'
+    save_status(config, status, export=True)
+    logging.info('Merged %d shards, %d tarballs verified, %d invalid.' % (n, len(filelist), len(invalid)))
+
+
 def try_update(name, update, config, status):
+    config.metrics.start_phase(name)
+    if config.profiler is not None:
+        config.profiler.start_phase(name)
     try:
         update(config, status)
     except Exception as e:
         logging.error('Failed to update %s' % name)
         status[name]['status'] = 'failed'
-        save_status(config, status, name)
+        save_status(config, status, name, export=True)
+        end_phase(config, False)
         raise e
+    save_status(config, status, name, export=True)
+    end_phase(config, True)
+
+
+def end_phase(config, success):
+    config.metrics.end_phase(success)
+    if config.metrics_file is not None:
+        config.metrics.save(config.metrics_file)
+    if config.profiler is not None:
+        config.profiler.end_phase(success)
 
 
 def main():
     config = get_config()
+    config.status_store = StatusStore(config.status_db)
+    config.metrics = Metrics()
+    metrics_server = None if config.metrics_port is None else start_metrics_server(config)
+    if config.profile_dir is not None:
+        config.profiler = Profiler(config.profile_dir, config.profile_python)
     status = get_current_status(config)
     if status is None or status.get('mirror_version') != VERSION:
         status = initialize(config, status)
+    # Settings may have changed.
+    save_status(config, status, export=True)
+    try:
+        run(config, status)
+    finally:
+        config.status_store.close()
+        if config.profiler is not None:
+            config.profiler.save()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+
+def update_shared(config, status):
+    # The shards would all download the same files here, and race on them in a shared tree, so these
+    # phases are left to --merge-shards.
     try_update('client', update_client, config, status)
     if config.mirror_releases:
         try_update('releases', update_releases, config, status)
     if config.mirror_metadata:
         try_update('metadata', update_metadata, config, status)
-    if len(config.registries) > 0:
-        try_update('registries', update_registries, config, status)
-    if config.mirror_packages:
-        try_update('packages', update_packages, config, status)
+
+
+def run(config, status):
+    if config.merge_shards:
+        merge_shards(config, status)
+        with DOWNLOADERS[config.engine](config) as downloader:
+            config.downloader = downloader
+            update_shared(config, status)
+        config.downloader = None
+    elif config.plan_mode == 'plan':
+        make_plan(config, status)
+        return
+    elif config.plan_mode == 'execute':
+        execute_plan(config, status)
+    else:
+        with DOWNLOADERS[config.engine](config) as downloader:
+            config.downloader = downloader
+            if config.shard is None:
+                update_shared(config, status)
+            if len(config.registries) > 0:
+                try_update('registries', update_registries, config, status)
+            if config.mirror_packages:
+                try_update('packages', update_packages, config, status)
+        config.downloader = None
+    # Like the index, the layout is written by --merge-shards instead of by each shard.
+    if config.pkg_server and config.shard is None:
+        try_update('server', update_server, config, status)
 
 
 if __name__ == '__main__':
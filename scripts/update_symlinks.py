@@ -1,75 +1,97 @@
-# This script is for fixing symbolic links generated by old version of mirror_julia.py.
-import glob
+#!/usr/bin/env python3
+# Checks the links of the package layout and repairs only the wrong ones:
+# - packages/<name>/<registry>/<name>, which points to the package in the registry,
+# - registries/<registry>/<X>/<name>/releases, which points back to the package folder,
+# - packages/<name>/<registry>/<name>-<version>.tar.gz(.sha256), which point to the tarballs named
+#   by git-tree-sha1. Version files left as plain files by old versions of mirror_julia.py are
+#   renamed to their git-tree-sha1 and linked.
+# The package folders are checked in batches by a pool of threads with os.scandir.
+import argparse
+import concurrent.futures
 import os
-import sys
-import toml
 
+from mirror_julia import TomlCache, read_registry_versions, set_link
 
-def makelink(src, dst):
-    if os.path.islink(dst):
-        os.unlink(dst)
-    src = os.path.relpath(src, os.path.dirname(dst))
-    os.symlink(src, dst)
+BATCH_SIZE = 64
 
 
-def main():
-    root = sys.argv[1]
-    packages_dir = os.path.join(root, 'packages')
-    registries_dir = os.path.join(root, 'registries')
-    package_list = glob.glob(os.path.join(packages_dir, '*/*/'))
-    for package in package_list:
-        registry = os.path.basename(package[:-1])
-        name = os.path.basename(os.path.dirname(package[:-1]))
-        linkdir = os.path.join(registries_dir, registry, name[0].upper(), name)
-        current_dir = package
-        print(current_dir)
-        makelink(current_dir, os.path.join(linkdir, 'releases'))
-        makelink(linkdir, os.path.join(current_dir, name))
-        with open(os.path.join(linkdir, 'Versions.toml')) as fi:
-            version_list = toml.load(fi)
-        for version in version_list:
-            sha = version_list[version]['git-tree-sha1']
-            filename = '%s-%s.tar.gz' % (name, sha)
-            filepath = os.path.join(current_dir, filename)
-            sha256_file = filepath + '.sha256'
-            version_filepath = os.path.join(current_dir, '%s-%s.tar.gz' % (name, version))
-            version_sha256 = version_filepath + '.sha256'
-            if os.path.exists(version_filepath):
-                os.rename(version_filepath, filepath)
-                makelink(filepath, version_filepath)
-            if os.path.exists(version_sha256):
-                os.rename(version_sha256, sha256_file)
-                makelink(sha256_file, version_sha256)
+def get_args():
+    parser = argparse.ArgumentParser(description='Check and repair the links of a Julia mirror.')
+    parser.add_argument('pathname', type=str, help='path to the mirror root')
+    parser.add_argument('--check', action='store_true', help='only report what is wrong without repairing it')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of threads checking the folders (default: %(default)s)')
+    return parser.parse_args()
+
+
+def check_link(src, dst, repair):
+    # Returns a description of the problem with the link, or `None` if it is right.
+    target = os.path.relpath(src, os.path.dirname(dst))
+    if os.path.islink(dst) and os.readlink(dst) == target:
+        return None
+    problem = '%s should point to %s' % (dst, target)
+    if repair:
+        set_link(src, dst)
+    return problem
+
 
+def check_package(root, registry, name, versions, repair):
+    problems = []
+    current_dir = os.path.join(root, 'packages', name, registry)
+    linkdir = os.path.join(root, 'registries', registry, name[0].upper(), name)
+    if versions is None or not os.path.isdir(linkdir):
+        # Not in the registry any more, see gc_mirror.py.
+        return problems
+    for (src, dst) in ((current_dir, os.path.join(linkdir, 'releases')),
+                       (linkdir, os.path.join(current_dir, name))):
+        problems.append(check_link(src, dst, repair))
+    entries = {entry.name: entry for entry in os.scandir(current_dir)}
+    for (version, info) in versions.items():
+        filename = '%s-%s.tar.gz' % (name, info['git-tree-sha1'])
+        version_filename = '%s-%s.tar.gz' % (name, version)
+        for suffix in ('', '.sha256'):
+            entry = entries.get(version_filename + suffix)
+            filepath = os.path.join(current_dir, filename + suffix)
+            if entry is not None and not entry.is_symlink() and filename + suffix not in entries:
+                problems.append('%s should be named %s' % (entry.path, filepath))
+                if repair:
+                    os.rename(entry.path, filepath)
+            elif filename + suffix not in entries:
+                # Not downloaded yet.
+                continue
+            problems.append(check_link(filepath, os.path.join(current_dir, version_filename + suffix), repair))
+    return [each for each in problems if each is not None]
 
-def main2():
-    root = sys.argv[1]
-    packages_dir = os.path.join(root, 'packages')
+
+def check_batch(root, batch, repair):
+    return [problem for args in batch for problem in check_package(root, *args, repair)]
+
+
+def main():
+    args = get_args()
+    root = os.path.abspath(args.pathname)
     registries_dir = os.path.join(root, 'registries')
-    package_list = glob.glob(os.path.join(packages_dir, '*/*/'))
-    for package in package_list:
-        registry = os.path.basename(package[:-1])
-        name = os.path.basename(os.path.dirname(package[:-1]))
-        linkdir = os.path.join(registries_dir, registry, name[0].upper(), name)
-        current_dir = package
-        print(current_dir)
-        makelink(current_dir, os.path.join(linkdir, 'releases'))
-        makelink(linkdir, os.path.join(current_dir, name))
-        with open(os.path.join(linkdir, 'Versions.toml')) as fi:
-            version_list = toml.load(fi)
-        for version in version_list:
-            sha = version_list[version]['git-tree-sha1']
-            filename = '%s-%s.tar.gz' % (name, sha)
-            filepath = os.path.join(current_dir, filename)
-            sha256_file = filepath + '.sha256'
-            version_filepath = os.path.join(current_dir, '%s-%s.tar.gz' % (name, version))
-            version_sha256 = version_filepath + '.sha256'
-            if os.path.exists(filepath):
-                makelink(filepath, version_filepath)
-            if os.path.exists(sha256_file):
-                makelink(sha256_file, version_sha256)
+    versions = {}
+    for entry in os.scandir(registries_dir):
+        if entry.is_dir(follow_symlinks=False) and os.path.isdir(entry.path + '.git'):
+            cache_file = os.path.join(root, 'cache', 'registries', entry.name + '.json')
+            versions[entry.name] = read_registry_versions(entry.path, TomlCache(cache_file))
+    packages = []
+    for package in os.scandir(os.path.join(root, 'packages')):
+        if package.is_dir(follow_symlinks=False):
+            for registry in os.scandir(package.path):
+                if registry.is_dir(follow_symlinks=False):
+                    packages.append((registry.name, package.name, versions.get(registry.name, {}).get(package.name)))
+    batches = [packages[i:i + BATCH_SIZE] for i in range(0, len(packages), BATCH_SIZE)]
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        tasks = [executor.submit(check_batch, root, batch, not args.check) for batch in batches]
+        problems = [problem for task in tasks for problem in task.result()]
+    for problem in problems:
+        print(problem)
+    print('Checked %d package folders: %d problems %s.' % (
+        len(packages), len(problems), 'found' if args.check else 'repaired'
+    ))
 
 
 if __name__ == '__main__':
-    # main()
-    main2()
+    main()